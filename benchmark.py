@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+    EMS throughput benchmarks.
+    The pipeline benchmarks drive `do_on_cluster()` on a `LocalCluster` with synthetic instances.
+    The micro benchmarks time the parameter and sink stages on their own, and the import of EMS in a fresh interpreter.
+    Results are written as JSON so that runs of different EMS versions can be compared.
+"""
+
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+from pandas import DataFrame
+from dask.distributed import Client, LocalCluster
+
+from EMS.manager import (do_on_cluster, unroll_experiment, remove_stop_list, dedup_experiment,
+                         SQLiteSink, FlushPolicy, timestamp, write_json)
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def _result(width: int, seed: int, values: np.ndarray) -> DataFrame:
+    d = {'width': width, 'seed': seed}
+    d.update({f'v{i:0>4}': v for i, v in enumerate(np.resize(values, width))})
+    return DataFrame(data=d, index=[0])
+
+
+def tiny(*, width: int, seed: int) -> DataFrame:
+    return _result(width, seed, np.arange(width, dtype=float))
+
+
+def medium(*, width: int, seed: int) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(200, 200))
+    return _result(width, seed, (X @ X.T).sum(axis=0))
+
+
+def svd(*, width: int, seed: int) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(500, 500))
+    _, _, Vh = np.linalg.svd(X)
+    return _result(width, seed, Vh[0, :])
+
+
+INSTANCES = {'tiny': tiny, 'medium': medium, 'svd': svd}
+# The optional backends and dask.distributed, which a worker or script should only import if it uses them.
+HEAVY_MODULES = ['pandas_gbq', 'google.cloud.sql.connector', 'google.oauth2', 'pg8000', 'sqlalchemy',
+                 'dask.distributed']
+
+
+def _timed(fn: callable, *args, **kwargs) -> float:
+    tick = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - tick
+
+
+def bench_pipeline(name: str, width: int, size: int, max_cells: int, n_workers: int = 4) -> dict:
+    table_name = f'bench_{name}_{width}_{size}_{max_cells}_{timestamp()}'
+    exp = dict(table_name=table_name, params=[{'width': [width], 'seed': list(range(size))}])
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)  # do_on_cluster() records the experiment in the current directory.
+        try:
+            with LocalCluster(n_workers=n_workers, threads_per_worker=1) as cluster:
+                with Client(cluster) as client:
+                    seconds = _timed(do_on_cluster, exp, INSTANCES[name], client,
+                                     db_url=f'sqlite:///{tmp}/bench.db3', policy=FlushPolicy(max_cells=max_cells))
+        finally:
+            os.chdir(cwd)
+    return {'benchmark': 'pipeline', 'instance': name, 'width': width, 'size': size, 'max_cells': max_cells,
+            'workers': n_workers, 'seconds': seconds, 'instances_per_second': size / seconds}
+
+
+def bench_unroll(size: int) -> dict:
+    exp = dict(table_name='bench', params=[{'a': list(range(size // 100)), 'b': np.linspace(0.25, 2.5, 100)}])
+    return {'benchmark': 'unroll_experiment', 'size': size, 'seconds': _timed(unroll_experiment, exp)}
+
+
+def bench_stop_list(size: int, stop_size: int) -> dict:
+    exp = dict(table_name='bench', params=[{'a': list(range(size // 100)), 'b': np.linspace(0.25, 2.5, 100)}])
+    parameters = unroll_experiment(exp)
+    stop = parameters[::max(size // stop_size, 1)]
+    return {'benchmark': 'remove_stop_list', 'size': size, 'stop_size': len(stop),
+            'seconds': _timed(remove_stop_list, parameters, stop)}
+
+
+def bench_dedup(size: int, done: float = 0.9) -> dict:
+    exp = dict(table_name='bench', params=[{'a': list(range(size // 100)), 'b': np.linspace(0.25, 2.5, 100)}])
+    parameters = unroll_experiment(exp)
+    df = DataFrame(parameters[:round(size * done)])
+    return {'benchmark': 'dedup_experiment', 'size': size, 'done': done,
+            'seconds': _timed(dedup_experiment, df, parameters)}
+
+
+def bench_sqlite(width: int, rows: int) -> dict:
+    rng = np.random.default_rng(0)
+    df = DataFrame(rng.normal(size=(rows, width)), columns=[f'v{i:0>4}' for i in range(width)])
+    with tempfile.TemporaryDirectory() as tmp:
+        sink = SQLiteSink(f'sqlite:///{tmp}/bench.db3')
+        sink.write('bench', df.head(1))  # Create the table outside of the timing.
+        seconds = _timed(sink.write, 'bench', df)
+        sink.engine.dispose()
+    return {'benchmark': 'sqlite_sink', 'width': width, 'rows': rows, 'seconds': seconds,
+            'rows_per_second': rows / seconds}
+
+
+def bench_import(module: str = 'EMS.manager', repeat: int = 5) -> dict:
+    """The best of `repeat` cold imports of `module`, each in a new interpreter, and the heavy modules it loaded."""
+    code = ('import json, sys, time\n'
+            'tick = time.perf_counter()\n'
+            f'import {module}\n'
+            'seconds = time.perf_counter() - tick\n'
+            f'print(json.dumps([seconds, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))')
+    runs = [json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True, check=True, text=True).stdout)
+            for _ in range(repeat)]
+    return {'benchmark': 'import', 'module': module, 'seconds': min(seconds for seconds, _ in runs),
+            'heavy_modules': runs[0][1]}
+
+
+def run_benchmarks(quick: bool = False) -> dict:
+    widths = [10, 100, 1000, 2000]
+    sizes = [100, 1000] if quick else [100, 1000, 10000]
+    results = [bench_import('EMS.manager'), bench_import('EMS.sinks.sqlite')]
+    for size in [10_000, 100_000] if quick else [10_000, 100_000, 1_000_000]:
+        results.append(bench_unroll(size))
+        results.append(bench_dedup(size))
+    for size, stop_size in [(10_000, 1_000), (100_000, 10_000)]:
+        results.append(bench_stop_list(size, stop_size))
+    for width in widths:
+        results.append(bench_sqlite(width, 1000))
+    for name in INSTANCES:
+        for width in widths:
+            for size in sizes if name == 'tiny' else sizes[:1]:
+                for max_cells in [20 * 1000, 200 * 1000]:
+                    results.append(bench_pipeline(name, width, size, max_cells))
+    try:
+        ems_version = version('EMS')
+    except PackageNotFoundError:
+        ems_version = None
+    return {'ems_version': ems_version, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'timestamp': timestamp(), 'results': results}
+
+
+if __name__ == "__main__":
+    report = run_benchmarks(quick=True)
+    fn = f'benchmark-{report["ems_version"]}-{report["timestamp"]}.json'
+    write_json(report, fn)
+    print(json.dumps(report, indent=4))
@@ -1,19 +1,11 @@
 #!/usr/bin/env python3
 
-from pandas import read_sql_table
-import sqlalchemy as sa
+from EMS.export import export_table, CSVTarget
 
 
 def copy_table_to_csv(table_name: str):
-    engine = sa.create_engine('sqlite:///data/EMS.db3', echo=False)
-
-    with engine.connect() as ldb:
-        df = read_sql_table(table_name, ldb)
-
-    # df.drop(columns=['index'], inplace=True)
-    df.to_csv(f'{table_name}.csv', index=False)
-
-    engine.dispose()
+    # Streams the rows added since the last copy to {table_name}.csv. See `python -m EMS.export --help`.
+    export_table(table_name, CSVTarget('.'))
 
 
 if __name__ == "__main__":
@@ -1,29 +1,42 @@
 #!/usr/bin/env python3
 
+import os
 import time
 import numpy as np
 from pandas import DataFrame
 
 from dask.distributed import Client, LocalCluster
 from dask_jobqueue import SLURMCluster
-from EMS.manager import do_on_cluster, get_gbq_credentials
+from EMS.manager import do_on_cluster, get_gbq_credentials, batch_instance, worker_memoize
+from EMS.manager import ThroughputScaler, lifetime_args, autotune
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
 
+# The signal only depends upon the shape. Each worker builds it once per shape.
+@worker_memoize
+def generate_signal(nrow: int, ncol: int) -> tuple:
+
+    # Create length-n vector u with element equal to (-1)^i/sqrt(n)
+    u = (-1.0)**np.arange(nrow)/np.sqrt(nrow)
+    v = (-1.0)**np.arange(1, ncol + 1)/np.sqrt(ncol)
+
+    # Generate signal
+    signal = 3 * np.outer(u,v)
+
+    for a in (u, v, signal):
+        a.flags.writeable = False  # Shared by every instance on the worker.
+    return u, v, signal
+
+
 # Function that generates data with noise; will use again in later homeworks
 def generate_data(nrow: int, ncol: int, seed: int = 0) -> tuple:
 
     # Set seed
     rng = np.random.default_rng(1 + seed * 10000)  # Ensure the seed is non-zero and spans a large range of values.
 
-    # Create length-n vector u with element equal to (-1)^i/sqrt(n)
-    u = np.array([(-1)**i/np.sqrt(nrow) for i in range(nrow)])
-    v = np.array([(-1)**(i+1)/np.sqrt(ncol) for i in range(ncol)])
-
-    # Generate signal
-    signal = 3 * np.outer(u,v)
+    u, v, signal = generate_signal(nrow=nrow, ncol=ncol)
 
     # noise matrix of normal(0,1)
     noise = rng.normal(0,1,(nrow,ncol))/np.sqrt(nrow*ncol)
@@ -34,7 +47,7 @@ def generate_data(nrow: int, ncol: int, seed: int = 0) -> tuple:
     return X, u, v, signal  # return data
 
 
-def experiment(*, nrow: int, ncol: int, seed: int) -> DataFrame:
+def experiment(*, nrow: int, ncol: int, seed: int) -> dict:
     tick = time.perf_counter()
 
     X, u_true, v_true, signal_true = generate_data(nrow, ncol, seed=seed)
@@ -58,13 +71,39 @@ def experiment(*, nrow: int, ncol: int, seed: int) -> DataFrame:
     # Calculate distance between signal_est and signal_true
     signal_error = np.linalg.norm(signal_est-signal_true)/np.sqrt(nrow*ncol)
 
-    # Save u_est, v_est, u_true, v_true in a CSV file with an index column
-    d = {'nrow': nrow, 'ncol': ncol, 'seed': seed, "v_alignment": v_align}
-    d.update({f've{i:0>3}': ve for i, ve in enumerate(v_est)})
-    df = DataFrame(data=d, index=[0])
+    # Return one row. EMS writes the vector v_est as the columns ve000, ve001, ...
+    d = {'nrow': nrow, 'ncol': ncol, 'seed': seed, "v_alignment": v_align, 've': v_est}
 
     # Print runtime
     logging.info(f"Seed: {seed}; {time.perf_counter() - tick} seconds.")
+    return d
+
+
+@batch_instance(group_by=['nrow', 'ncol'])
+def experiment_batch(params: DataFrame) -> DataFrame:
+    tick = time.perf_counter()
+    nrow, ncol = int(params['nrow'].iloc[0]), int(params['ncol'].iloc[0])  # The same for the whole batch.
+    seeds = params['seed'].to_numpy()
+
+    # Stack one data matrix per seed; the signal is shared.
+    data = [generate_data(nrow, ncol, seed=int(seed)) for seed in seeds]
+    X = np.stack([d[0] for d in data])
+    v_true = data[0][2]
+
+    # Analyze all of the data using one batched SVD
+    _, _, Vh = np.linalg.svd(X)
+    v_est = Vh[:, 0, :]
+
+    # Calculate alignment between v_est and v_true
+    v_align = v_est @ v_true
+
+    df = DataFrame(v_est, columns=[f've{i:0>3}' for i in range(ncol)])
+    df.insert(0, 'v_alignment', v_align)
+    df.insert(0, 'seed', seeds)
+    df.insert(0, 'ncol', ncol)
+    df.insert(0, 'nrow', nrow)
+
+    logging.info(f"Seeds: {len(seeds)}; {time.perf_counter() - tick} seconds.")
     return df
 
 
@@ -88,13 +127,18 @@ def build_params(size: int = 1, su_id: str = 'su_ID') -> dict:
     return exp
 
 
-def do_cluster_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None):
+def do_cluster_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None, target: float = None):
     exp = build_params(size=size, su_id=su_id)
-    with SLURMCluster(cores=8, memory='4GiB', processes=1, walltime='00:15:00') as cluster:
+    walltime = '00:15:00'
+    # With a target, the scaler sizes the cluster and replaces jobs that retire before their walltime.
+    extra_args = lifetime_args(walltime) if target is not None else []
+    with SLURMCluster(cores=8, memory='4GiB', processes=1, walltime=walltime,
+                      worker_extra_args=extra_args) as cluster:
         cluster.scale(8)
         logging.info(cluster.job_script())  # Log a copy of the sbatch script.
+        scaler = ThroughputScaler(cluster, target, maximum=32) if target is not None else None
         with Client(cluster) as client:
-            do_on_cluster(exp, experiment, client, credentials=credentials)
+            do_on_cluster(exp, experiment, client, credentials=credentials, scaler=scaler)
         cluster.scale(0)
 
 
@@ -105,6 +149,30 @@ def do_local_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None):
             do_on_cluster(exp, experiment, client, credentials=credentials)
 
 
+def do_local_scaled_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None, target: float = 600.0):
+    # A LocalCluster stands in for SLURM to exercise the ThroughputScaler.
+    exp = build_params(size=size, su_id=su_id)
+    with LocalCluster(n_workers=1, threads_per_worker=1) as cluster:
+        scaler = ThroughputScaler(cluster, target, maximum=os.cpu_count(), interval=5.0)
+        with Client(cluster) as client:
+            do_on_cluster(exp, experiment, client, credentials=credentials, scaler=scaler)
+
+
+def do_local_autotuned_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None):
+    exp = build_params(size=size, su_id=su_id)
+    layout = autotune(exp, experiment, sample=32)  # Recorded in the experiment JSON.
+    with LocalCluster(n_workers=layout['processes'], threads_per_worker=layout['threads']) as cluster:
+        with Client(cluster) as client:
+            do_on_cluster(exp, experiment, client, credentials=credentials)
+
+
+def do_local_batch_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None):
+    exp = build_params(size=size, su_id=su_id)
+    with LocalCluster() as cluster:
+        with Client(cluster) as client:
+            do_on_cluster(exp, experiment_batch, client, credentials=credentials, chunk_size=16)
+
+
 if __name__ == "__main__":
     # experiment(nrow=1000, ncol=1000, seed=285)
     do_local_experiment(size=1000, su_id='su_ID_1')
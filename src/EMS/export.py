@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+    Incremental export of the local SQLite results to CSV, Parquet or BigQuery.
+    A table is streamed in chunks of rows, in the order they were appended, and the chunks are written while the
+    next ones are read. A high-water mark per table and target, kept in the `ems_exports` table of the same database,
+    lets the next run export only the rows added since. A chunk is marked once it, and every chunk before it, has
+    been written, so an interrupted export resumes where it stopped and repeats at most the chunks in flight.
+    A full export, or the first one, replaces the table's CSV or Parquet files, e.g. those of `copy_local_db_to_csv.py`.
+    Run `python -m EMS.export --help` for the command line.
+"""
+
+import argparse
+import inspect
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pandas import DataFrame
+from sqlalchemy import text
+
+from EMS.manager import CHUNK_ROWS, LOCAL_DB_URL, Databases, _now
+from EMS.sinks import load_sink
+
+EXPORT_PARALLEL = 4  # Chunks written at once by the targets that allow it.
+logger = logging.getLogger(__name__)
+
+
+class CSVTarget(object):
+    """Appends to `<root>/<table_name>.csv`. The header is written with the first row."""
+    parallel = False  # The appends must stay in order.
+
+    def __init__(self, root: str = '.'):
+        self.root = Path(root)
+        self.key = f'csv:{self.root.resolve()}'
+
+    def reset(self, table_name: str):
+        (self.root / f'{table_name}.csv').unlink(missing_ok=True)
+
+    def write(self, table_name: str, df: DataFrame, first: int, last: int):
+        path = self.root / f'{table_name}.csv'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        header = not path.exists() or path.stat().st_size == 0
+        df.to_csv(path, mode='a', header=header, index=False)
+
+
+class ParquetTarget(object):
+    """
+    Writes each chunk as `<root>/<table_name>/part-<first rowid>-<last rowid>.parquet`. A repeated chunk overwrites
+    its own file. Requires `pyarrow` (`pip install EMS[parquet]`).
+    """
+    parallel = True
+
+    def __init__(self, root: str = 'export'):
+        self.root = Path(root)
+        self.key = f'parquet:{self.root.resolve()}'
+
+    def reset(self, table_name: str):
+        for part in (self.root / table_name).glob('part-*.parquet'):
+            part.unlink()
+
+    def write(self, table_name: str, df: DataFrame, first: int, last: int):
+        path = self.root / table_name
+        path.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(path / f'part-{first:0>12}-{last:0>12}.parquet', index=False)
+
+
+class GBQTarget(object):
+    """
+    Appends each chunk to `<dataset>.<table_name>` with its own BigQuery load job. A full export, or the first
+    one, deletes the table first; the first load job creates it again with the exported columns.
+    """
+    parallel = True
+
+    def __init__(self, credentials=None, project_id: str = None, dataset: str = 'EMS'):
+        self.sink = load_sink('gbq').GBQSink(credentials, project_id, dataset)
+        project = credentials.project_id if credentials is not None else project_id
+        self.key = f'gbq:{project}.{dataset}'
+
+    def reset(self, table_name: str):
+        self.sink.drop(table_name)
+
+    def write(self, table_name: str, df: DataFrame, first: int, last: int):
+        self.sink.append(table_name, df)
+
+
+def _create_marks(db: Databases):
+    with db.sqlite.engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS ems_exports (table_name TEXT, target TEXT, ' +
+                          'last_rowid INTEGER, rows INTEGER, time TEXT, PRIMARY KEY (table_name, target))'))
+
+
+def get_mark(db: Databases, target_key: str) -> int:
+    """The rowid of the last row of `db`'s table exported to the target, or 0."""
+    _create_marks(db)
+    with db.sqlite.engine.connect() as conn:
+        row = conn.execute(text('SELECT last_rowid FROM ems_exports WHERE table_name = :t AND target = :k'),
+                           {'t': db.table_name, 'k': target_key}).fetchone()
+    return row[0] if row is not None else 0
+
+
+def clear_mark(db: Databases, target_key: str):
+    _create_marks(db)
+    with db.sqlite.engine.begin() as conn:
+        conn.execute(text('DELETE FROM ems_exports WHERE table_name = :t AND target = :k'),
+                     {'t': db.table_name, 'k': target_key})
+
+
+def set_mark(db: Databases, target_key: str, last_rowid: int, rows: int):
+    """Record that the rows up to `last_rowid` have been exported; `rows` is added to the target's total."""
+    with db.sqlite.engine.begin() as conn:
+        conn.execute(text('INSERT INTO ems_exports VALUES (:t, :k, :last, :rows, :time) ' +
+                          'ON CONFLICT (table_name, target) DO UPDATE SET last_rowid = excluded.last_rowid, ' +
+                          'rows = ems_exports.rows + excluded.rows, time = excluded.time'),
+                     {'t': db.table_name, 'k': target_key, 'last': last_rowid, 'rows': rows,
+                      'time': _now().isoformat()})
+
+
+def export_table(table_name: str, target, db_url: str = LOCAL_DB_URL, chunksize: int = CHUNK_ROWS,
+                 parallel: int = EXPORT_PARALLEL, full: bool = False, keep_index: bool = False) -> int:
+    """
+    Export the rows of the local table added since the last export to `target`. Returns the number of rows exported.
+    `full` exports every row again. The pandas `index` column, a row number within a flush, is dropped unless
+    `keep_index`.
+    """
+    db = Databases(table_name, db_url=db_url)
+    n_rows = 0
+    try:
+        after = 0 if full else get_mark(db, target.key)
+        start_over = after == 0
+        in_flight = deque()  # (future, last rowid, rows), in rowid order.
+
+        def mark_done(wait: bool):
+            nonlocal n_rows
+            last, rows = None, 0
+            try:
+                while len(in_flight) > 0 and (wait or in_flight[0][0].done()):
+                    future, chunk_last, n = in_flight[0]
+                    future.result()  # Raises the write's exception; the mark stays before the failed chunk.
+                    in_flight.popleft()
+                    last, rows = chunk_last, rows + n
+            finally:
+                if last is not None:
+                    set_mark(db, target.key, last, rows)
+                    n_rows += rows
+
+        workers = max(parallel, 1) if target.parallel else 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='EMS-export') as pool:
+            try:
+                for df in db.sqlite.read_chunks(table_name, chunksize, after):
+                    first, last = int(df.index[0]), int(df.index[-1])
+                    if not keep_index:
+                        df = df.drop(columns=['index'], errors='ignore')
+                    df = df.reset_index(drop=True)
+                    if start_over:  # Replace, rather than append to, the output of an earlier export.
+                        start_over = False
+                        clear_mark(db, target.key)
+                        if (reset := getattr(target, 'reset', None)) is not None:
+                            reset(table_name)
+                    in_flight.append((pool.submit(target.write, table_name, df, first, last), last, len(df)))
+                    df = None
+                    if len(in_flight) >= workers:  # Bounds the chunks held in memory.
+                        in_flight[0][0].result()
+                    mark_done(wait=False)
+            finally:
+                mark_done(wait=True)
+    finally:
+        db.final_push()
+    logger.info(f'Exported {n_rows} rows of {table_name} to {target.key}')
+    return n_rows
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(prog='python -m EMS.export', description=inspect.cleandoc(__doc__),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tables', nargs='+', help='the tables to export')
+    parser.add_argument('--to', choices=['csv', 'parquet', 'gbq'], default='csv', help='the target (default: csv)')
+    parser.add_argument('--out', default='.', help='the directory of the CSV or Parquet files (default: .)')
+    parser.add_argument('--dataset', default='EMS', help='the BigQuery dataset (default: EMS)')
+    parser.add_argument('--credentials', help='a service account file in ~/.config/gcloud/ for BigQuery')
+    parser.add_argument('--project-id', help='the BigQuery project, if not using a service account')
+    parser.add_argument('--db-url', default=LOCAL_DB_URL, help=f'the local database (default: {LOCAL_DB_URL})')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help=f'rows per chunk (default: {CHUNK_ROWS})')
+    parser.add_argument('--parallel', type=int, default=EXPORT_PARALLEL,
+                        help=f'chunks written at once to Parquet or BigQuery (default: {EXPORT_PARALLEL})')
+    parser.add_argument('--full', action='store_true', help='export every row, not just the ones added since')
+    parser.add_argument('--keep-index', action='store_true', help="keep the pandas 'index' column")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.to == 'csv':
+        target = CSVTarget(args.out)
+    elif args.to == 'parquet':
+        target = ParquetTarget(args.out)
+    else:
+        credentials = None
+        if args.credentials is not None:
+            credentials = load_sink('gbq').get_gbq_credentials(os.path.basename(args.credentials))
+        target = GBQTarget(credentials, args.project_id, args.dataset)
+    for table_name in args.tables:
+        export_table(table_name, target, db_url=args.db_url, chunksize=args.chunk_rows, parallel=args.parallel,
+                     full=args.full, keep_index=args.keep_index)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,228 +4,656 @@
     Donoho Lab Experiment Management System
 """
 
+from __future__ import annotations
+
+import bisect
 import copy
+import functools
+import hashlib
+import heapq
+import importlib
+import inspect as pyinspect
+import itertools
 import json
 import logging
+import math
+import numbers
 import os
+import pickle
+import queue
 import random
+import sqlite3
+import sys
+import threading
 import time
+import traceback
+import weakref
+from array import array
+from collections import defaultdict
 from datetime import datetime, timezone, timedelta
-from math import floor
+from math import floor, prod
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator, Sequence
 
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
-import pandas_gbq.exceptions
-from dask.distributed import Client, as_completed
-from google.cloud.sql.connector import Connector
-from google.oauth2 import service_account
-from pg8000.dbapi import Connection
-from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
-from sqlalchemy.exc import SQLAlchemyError, OperationalError
-from sqlalchemy.schema import MetaData
-
-BATCH_SIZE = 4096
+
+from EMS.sinks import BATCH_SIZE, LOCAL_DB_URL, SQLITE_PRAGMAS, load_sink
+
+if TYPE_CHECKING:  # The backends and dask.distributed are imported where they are used.
+    from dask.distributed import Client
+    from google.oauth2 import service_account
+    from sqlalchemy.engine import Engine
+    from EMS.plugins import SetupCache
+
+SETUP_CACHE_SIZE = 8  # Setup values kept per worker by worker_memoize().
+CACHE_PATH = 'data/EMS-cache.db3'
+CACHE_BYTES = 4 * 2**30  # The result cache evicts the least recently used results beyond this size.
+METRICS_INTERVAL = 10.0  # Seconds between the throughput samples written by Metrics.
+FLUSH_BYTES = 512 * 2**20  # Default driver memory budget for buffered results.
 NUM_CELLS = 200 * 1000  # 200 rows x 1,000 columns. Slightly less than the values used on FarmShare
+IN_FLIGHT_PER_THREAD = 4  # Default submission window: tasks kept in flight per worker thread.
+WORKERS_INTERVAL = 5.0  # Seconds the driver reuses the scheduler's list of workers before asking again.
+TASK_SECONDS = 0.5  # Adaptive chunking aims for this much compute per task, well above the scheduler's overhead.
+MAX_CHUNK_SIZE = 1024  # Most instances packed into one task by adaptive chunking.
+MAX_PENDING_POINTS = 4 * BATCH_SIZE  # Points held in partly filled chunks before the oldest one is sent anyway.
+AUTOTUNE_SAMPLE = 64  # Instances timed per candidate layout by autotune().
+SCALE_INTERVAL = 30.0  # Seconds between the scaling decisions of ThroughputScaler.
+STATUS_INTERVAL = 60.0  # Seconds between the progress reports of ExperimentScheduler.
+SPECULATE_AFTER = 2.0  # A task is a straggler once it has run this many times its expected duration.
+CHUNK_ROWS = 10_000  # Rows per chunk of Databases.read_chunks() and the exports; 80 MB at 1,000 float columns.
+ARRAY_DIGITS = 3  # An array field `v` is written as the columns v000, v001, ..., as the instances used to name them.
+STOP_LIST_DIGITS = 12  # Significant digits compared when matching float parameters against the stop list.
 logger = logging.getLogger(__name__)
 
+# Names that moved into modules with expensive imports. They are still importable from here, on first use.
+_LAZY = {
+    'SQLiteSink': 'EMS.sinks.sqlite',
+    'PARQUET_ROOT': 'EMS.sinks.parquet',
+    'PARQUET_COMPACT_FILES': 'EMS.sinks.parquet',
+    'ParquetSink': 'EMS.sinks.parquet',
+    'pg_copy_insert': 'EMS.sinks.postgres',
+    'create_remote_connection_engine': 'EMS.sinks.postgres',
+    'active_remote_engine': 'EMS.sinks.postgres',
+    'get_gbq_credentials': 'EMS.sinks.gbq',
+    'SetupCache': 'EMS.plugins',
+    'BlasThreads': 'EMS.plugins',
+    'SharedInput': 'EMS.plugins',
+}
+
+
+def __getattr__(name: str):
+    if (module := _LAZY.get(name, None)) is not None:
+        return getattr(importlib.import_module(module), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 def _now() -> datetime:
     return datetime.now(timezone.utc)
 
 
-def _touch_db_url(db_url: str):
-    db_path = db_url.split('sqlite:///')
-    if db_path[0] != db_url:  # If the string was found …
-        p = Path(db_path[1])
-        p.parent.mkdir(parents=True, exist_ok=True)
-        p.touch(exist_ok=True)
+class FlushPolicy(object):
+    """
+    When `Databases` writes its buffered results: as soon as any limit is reached. A limit of None is no limit.
+    `max_bytes` is the driver's memory budget for buffered results.
+    `min_rows` maps a sink name ('local', 'parquet', 'remote' or 'gbq') to the fewest rows it writes at once.
+    BigQuery load jobs are slow to start and rate limited, so `{'gbq': 100_000}` makes each one count. Those rows are
+    held by the sink, outside of `max_bytes`, until the minimum or the final push is reached.
+    """
+
+    def __init__(self, max_bytes: int | None = FLUSH_BYTES, max_rows: int | None = None,
+                 max_cells: int | None = NUM_CELLS, max_age: float | None = 60.0, min_rows: dict = None):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.max_cells = max_cells
+        self.max_age = timedelta(seconds=max_age) if max_age is not None else None
+        self.min_rows = min_rows if min_rows is not None else {}
+
+    def is_full(self, rows: int, cells: int, n_bytes: int) -> bool:
+        return ((self.max_bytes is not None and n_bytes > self.max_bytes) or
+                (self.max_rows is not None and rows > self.max_rows) or
+                (self.max_cells is not None and cells > self.max_cells))
+
+    def is_stale(self, age: timedelta) -> bool:
+        return self.max_age is not None and age > self.max_age
+
+
+class _MinBatch(object):
+    """Hold a sink's writes until they reach `min_rows` rows, then write them as one DataFrame."""
+
+    def __init__(self, write: callable, min_rows: int):
+        self.write = write
+        self.min_rows = min_rows
+        self.pending = []
+        self.rows = 0
+
+    def __call__(self, df: DataFrame):
+        self.pending.append(df)
+        self.rows += len(df)
+        if self.rows >= self.min_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            df = pd.concat(self.pending, ignore_index=True)
+            self.pending = []
+            self.rows = 0
+            self.write(df)
+
+
+def _column_dtype(dtype) -> np.dtype:
+    """Strings, pandas extension types and other Python objects are stored as objects, so they are never truncated."""
+    return dtype if isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM' else np.dtype(object)
+
+
+def _dtype(value) -> np.dtype:
+    return _column_dtype(np.asarray(value).dtype)
+
+
+def _promote(a: np.dtype, b: np.dtype) -> np.dtype:
+    if a == b:
+        return a
+    if a.kind in 'biufc' and b.kind in 'biufc':
+        return np.promote_types(a, b)
+    return np.dtype(object)
+
+
+def _result_rows(result) -> int:
+    if isinstance(result, dict):
+        return 1
+    if isinstance(result, (np.ndarray, np.void)):  # A record of a structured array is a np.void.
+        return 1 if result.ndim == 0 else len(result)
+    return len(result)
+
+
+def _take(result, start: int, n: int):
+    """Rows `start` to `start + n` of a result."""
+    if isinstance(result, dict):
+        return result
+    if isinstance(result, (np.ndarray, np.void)):
+        return result if result.ndim == 0 else result[start:start + n]
+    return result.iloc[start:start + n]
+
+
+def _schema_key(result):
+    if isinstance(result, dict):
+        return tuple((k, np.shape(v)) for k, v in result.items())
+    if isinstance(result, (np.ndarray, np.void)) and result.dtype.names is not None:
+        return result.dtype
+    if isinstance(result, DataFrame):
+        return tuple(result.columns)
+    raise TypeError(f'Unsupported result type: {type(result).__name__}; ' +
+                    'expected a dict, a NumPy structured array or a DataFrame')
+
+
+class ResultBuffer(object):
+    """
+    A columnar buffer of results that share a schema, which is inferred from the first result.
+    A result is a dict, one row, whose values are scalars or arrays; a NumPy structured array, whose sub-array
+    fields are arrays; or a DataFrame. Rows are copied into preallocated NumPy columns, whose capacity doubles as
+    needed, so a flush builds one DataFrame rather than concatenating one per instance.
+    An array-valued field `v` is written as the columns `v000`, `v001`, ..., zero padded to `ARRAY_DIGITS` digits.
+    A column's dtype is promoted when a later result needs it, e.g. an int column that receives a float.
+    A None scalar is a missing value. It is NaN in a numeric column, so an int column becomes float64; only strings
+    and other objects widen a column to object.
+    """
+
+    def __init__(self, result):
+        self.fields = {}  # Name -> (dtype, number of elements, or None for a scalar).
+        self.types = {}  # Name -> the Python type of the scalar last stored, to detect a needed promotion cheaply.
+        self.row_bytes = 0
+        if isinstance(result, dict):
+            for name, value in result.items():
+                if isinstance(value, (np.ndarray, list, tuple)):
+                    value = np.ravel(np.asarray(value))
+                    self.fields[name] = (_column_dtype(value.dtype), value.size)
+                    self.row_bytes += value.nbytes
+                else:
+                    dtype = _dtype(value) if value is not None else np.dtype(np.float64)  # Until a value says more.
+                    self.fields[name] = (dtype, None)
+                    self.types[name] = type(value) if value is not None else float
+                    self.row_bytes += sys.getsizeof(value) if dtype.kind == 'O' else dtype.itemsize
+        elif isinstance(result, (np.ndarray, np.void)):
+            for name in result.dtype.names:
+                dtype, _ = result.dtype.fields[name][:2]
+                self.fields[name] = (_column_dtype(dtype.base), prod(dtype.shape) if dtype.shape else None)
+            self.row_bytes = result.dtype.itemsize
+        else:
+            for name in result.columns:
+                self.fields[name] = (_column_dtype(result[name].dtype), None)
+            self.row_bytes = result.memory_usage(deep=True, index=False).sum() / max(len(result), 1)
+        self.cells = sum(1 if width is None else width for _, width in self.fields.values())
+        self.columns = {}
+        self.capacity = 0
+        self.n = 0
+
+    def reserve(self, capacity: int):
+        """Grow every column to hold at least `capacity` rows."""
+        if capacity <= self.capacity:
+            return
+        for name, (dtype, width) in self.fields.items():
+            column = np.empty((capacity,) if width is None else (capacity, width), dtype=dtype)
+            if self.n > 0:
+                column[:self.n] = self.columns[name][:self.n]
+            self.columns[name] = column
+        self.capacity = capacity
+
+    def _retype(self, name: str, dtype: np.dtype) -> np.ndarray:
+        column = self.columns[name]
+        if (new := _promote(column.dtype, dtype)) != column.dtype:
+            column = column.astype(new)
+            self.columns[name] = column
+            self.fields[name] = (new, self.fields[name][1])
+        return column
+
+    def append(self, result) -> int:
+        """Copy a result into the buffer. Returns its number of rows."""
+        if isinstance(result, dict):
+            n_row = 1
+            if self.n + 1 > self.capacity:
+                self.reserve(max(2 * self.capacity, 1))
+            for name, value in result.items():
+                column = self.columns[name]
+                if self.fields[name][1] is not None:
+                    value = np.ravel(value)
+                    if value.dtype != column.dtype:
+                        column = self._retype(name, value.dtype)
+                elif value is None:  # Missing: NaN in a numeric column, NaT in a datetime one, None otherwise.
+                    if column.dtype.kind in 'biu':
+                        column = self._retype(name, np.dtype(np.float64))
+                    if column.dtype.kind in 'fc':
+                        value = np.nan
+                elif type(value) is not self.types[name]:
+                    column = self._retype(name, _dtype(value))
+                    self.types[name] = type(value)
+                column[self.n] = value
+        else:
+            if isinstance(result, (np.ndarray, np.void)):
+                result = np.asarray(result).reshape(-1)
+                arrays = {name: result[name] for name in self.fields}
+            else:
+                arrays = {name: result[name].to_numpy() for name in self.fields}
+            n_row = len(result)
+            if self.n + n_row > self.capacity:
+                self.reserve(max(2 * self.capacity, self.n + n_row))
+            for name, values in arrays.items():
+                column = self.columns[name]
+                if self.fields[name][1] is not None:
+                    values = values.reshape(n_row, -1)
+                if values.dtype != column.dtype:
+                    column = self._retype(name, values.dtype)
+                column[self.n:self.n + n_row] = values
+        self.n += n_row
+        return n_row
+
+    def to_frame(self) -> DataFrame:
+        """The buffered rows as one DataFrame. The buffer is emptied, but keeps its capacity."""
+        data = {}
+        for name, (_, width) in self.fields.items():
+            column = self.columns[name][:self.n]
+            if width is None:
+                data[name] = column
+            else:
+                data.update({f'{name}{i:0>{ARRAY_DIGITS}}': column[:, i] for i in range(width)})
+        df = DataFrame(data, copy=True)  # The columns are reused by the next flush.
+        self.n = 0
+        return df
+
+
+class Metrics(object):
+    """
+    A time series of an experiment run, one JSON object per line.
+    'flush' rows record each sink write: its latency and row count.
+    'sample' rows, written every `interval` seconds, record throughput, ETA and the bytes buffered in `Databases`.
+    They also record the mean worker compute time and result size of the instances since the last sample, and
+    the mean queue wait of their tasks; with chunking, a task runs several instances but waits once.
+    Queue wait compares the worker's wall clock with the driver's, so it is only as good as their clock sync.
+    """
+
+    def __init__(self, path: str, interval: float = METRICS_INTERVAL):
+        self.path = path
+        self.file = open(path, 'a')
+        self.interval = interval
+        self.lock = threading.Lock()  # Sink writer threads record flushes.
+        self.tick = time.perf_counter()
+        self.last_sample = self.tick
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.tasks = 0
+        self.compute = 0.0
+        self.wait = 0.0
+        self.result_bytes = 0
+
+    def _write(self, row: dict):
+        row = {'time': _now().isoformat(), 'elapsed': round(time.perf_counter() - self.tick, 6)} | row
+        with self.lock:
+            self.file.write(json.dumps(row) + '\n')
+            self.file.flush()
+
+    def instances(self, count: int, compute: float, wait: float, result_bytes: int):
+        """Record a task of `count` instances: seconds of compute per instance, seconds queued and result size."""
+        self.count += count
+        self.tasks += 1
+        self.compute += compute * count
+        self.wait += wait
+        self.result_bytes += result_bytes
+
+    def flush(self, sink: str, rows: int, seconds: float):
+        self._write({'event': 'flush', 'sink': sink, 'rows': rows, 'seconds': round(seconds, 6),
+                     'rows_per_second': round(rows / max(seconds, 1e-9), 1)})
+
+    def sample(self, done: int, remaining: int, buffered_bytes: int, force: bool = False):
+        now = time.perf_counter()
+        if not force and now - self.last_sample < self.interval:
+            return
+        elapsed = now - self.tick
+        throughput = done / elapsed if elapsed > 0 else 0.0
+        n = max(self.count, 1)
+        self._write({'event': 'sample', 'done': done, 'remaining': remaining,
+                     'instances_per_second': round(throughput, 3),
+                     'eta_seconds': round(remaining / throughput) if throughput > 0 else None,
+                     'buffered_bytes': buffered_bytes,
+                     'compute_seconds': round(self.compute / n, 6), 'queue_wait_seconds': round(self.wait / max(self.tasks, 1), 6),
+                     'result_bytes': round(self.result_bytes / n)})
+        self.last_sample = now
+        self._reset()
+
+    def timed(self, sink: str, write: callable) -> callable:
+        """Wrap a sink's write function so each call records a 'flush' row."""
+        def timed_write(df: DataFrame):
+            tick = time.perf_counter()
+            write(df)
+            self.flush(sink, len(df), time.perf_counter() - tick)
+        return timed_write
+
+    def close(self):
+        self.file.close()
+
+
+class _SinkWriter(threading.Thread):
+    """
+    Drains a bounded queue of DataFrames into a single sink on its own thread.
+    When the queue is full, `put()` blocks the caller. That is the backpressure.
+    """
+
+    def __init__(self, name: str, write: callable, maxsize: int = 4):
+        super().__init__(name=f'EMS-{name}-writer', daemon=True)
+        self.write = write
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            df = self.queue.get()
+            try:
+                if df is None:  # Sentinel from close().
+                    if (flush := getattr(self.write, 'flush', None)) is not None:
+                        flush()
+                else:
+                    self.write(df)
+            except Exception as e:
+                logger.error(f'{self.name}: {e}')
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if df is None:  # Even if the final flush failed; close() is joining this thread.
+                break
+
+    def _raise_error(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def put(self, df: DataFrame):
+        self._raise_error()
+        self.queue.put(df)
+
+    def drain(self):
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self._raise_error()
 
 
 class Databases(object):
 
     def __init__(self, table_name: str,
                  remote: Engine = None,  # SQLAlchemy based systems
-                 credentials: service_account.credentials = None, project_id: str = None):  # Google Big Query.
-        self.results = []
+                 credentials: service_account.credentials = None, project_id: str = None,  # Google Big Query.
+                 asynchronous: bool = False, queue_size: int = 4,
+                 db_url: str = LOCAL_DB_URL,  # Use a separate SQLite file per concurrent experiment.
+                 parquet: bool = False, partition_by: list = None,  # Columnar store under data/<table_name>/.
+                 remote_copy: bool = False,  # Load the PostgreSQL remote with COPY.
+                 remote_writers: int = 0,  # Concurrent asyncpg writes to the remote; 0 writes synchronously.
+                 policy: FlushPolicy = None, metrics: Metrics = None):
+        self.buffers = {}  # Result schema -> ResultBuffer
+        self.n_results = 0
+        self.metrics = metrics
         self.last_save = _now()
+        self.policy = policy if policy is not None else FlushPolicy()
+        # Running totals of the buffered results, so flush decisions take constant time.
+        self.n_rows = 0
+        self.n_cells = 0
+        self.n_bytes = 0
         self.table_name = table_name
-        db_url = 'sqlite:///data/EMS.db3'
-        _touch_db_url(db_url)
-        self.local = create_engine(db_url, echo=False)
-        self.remote = remote
-        self.credentials = credentials
-        self.project_id = project_id
+        # Only the configured backends are imported; see EMS.sinks.
+        self.sqlite = load_sink('local').SQLiteSink(db_url)
+        self.parquet = load_sink('parquet').ParquetSink(table_name, partition_by=partition_by) if parquet else None
+        if remote is None:
+            self.remote = None
+        elif remote_writers > 0:
+            self.remote = load_sink('remote').AsyncPostgresSink(remote, remote_writers)
+        else:
+            self.remote = load_sink('remote').PostgresSink(remote, remote_copy)
+        if credentials is not None or project_id is not None:
+            self.gbq = load_sink('gbq').GBQSink(credentials, project_id)
+        else:
+            self.gbq = None
+        # In asynchronous mode, each sink gets its own writer thread so the local, remote and GBQ writes overlap
+        # with each other and with result collection on the driver.
+        self.sinks = self._sinks()
+        self.writers = [_SinkWriter(name, write, queue_size) for name, write in self.sinks] if asynchronous else []
 
-    def _push_to_database(self):
-        df = pd.concat(self.results)
-        df.reset_index(drop=True, inplace=True)
-        logger.warning(f'_push_to_database(): Number of DataFrames: {len(self.results)}; ' +
-                       f'Length of DataFrames: {sum(len(result) for result in self.results)}\n{df}')
-        self.results = []
+    def _sinks(self) -> list:
+        sinks = [('local', self._write_local)]
+        if self.parquet is not None:
+            sinks.append(('parquet', self.parquet.write))
+        if self.remote is not None:
+            sinks.append(('remote', self._write_remote))
+        if self.gbq is not None:
+            sinks.append(('gbq', self._write_gbq))
+        if self.metrics is not None:
+            sinks = [(name, self.metrics.timed(name, write)) for name, write in sinks]
+        return [(name, _MinBatch(write, min_rows) if (min_rows := self.policy.min_rows.get(name, 0)) > 0 else write)
+                for name, write in sinks]
+
+    def _write_local(self, df: DataFrame):
         # Store locally for durability.
-        with self.local.connect() as ldb:
-            df.to_sql(self.table_name, ldb, if_exists='append', method='multi')
+        self.sqlite.write(self.table_name, df)
+
+    def _write_remote(self, df: DataFrame):
         # Store remotely for flexibility.
-        if self.remote is not None:
-            try:
-                with self.remote.connect() as rdb:
-                    df.to_sql(self.table_name, rdb, if_exists='append', method='multi')
-            except SQLAlchemyError as e:
-                logger.error("%s", e)
-        if self.credentials is not None:
-            try:
-                df.to_gbq(f'EMS.{self.table_name}',
-                          if_exists='append',
-                          progress_bar=False,
-                          credentials=self.credentials)
-            except pandas_gbq.exceptions.GenericGBQException as e:
-                logger.error("%s", e)
-        elif self.project_id is not None:
-            try:
-                df.to_gbq(f'EMS.{self.table_name}',
-                          if_exists='append',
-                          progress_bar=False,
-                          project_id=self.project_id)
-            except pandas_gbq.exceptions.GenericGBQException as e:
-                logger.error("%s", e)
+        self.remote.write(self.table_name, df)
+
+    def _write_gbq(self, df: DataFrame):
+        self.gbq.write(self.table_name, df)
+
+    def _push_to_database(self):
+        frames = [buffer.to_frame() for buffer in self.buffers.values() if buffer.n > 0]
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)  # One frame per schema.
+        frames = None
+        logger.warning(f'_push_to_database(): Number of Results: {self.n_results}; ' +
+                       f'Length of DataFrames: {self.n_rows}; Bytes: {self.n_bytes}\n{df}')
+        self.n_results = 0
+        self.n_rows = 0
+        self.n_cells = 0
+        self.n_bytes = 0
+        if len(self.writers) > 0:
+            for writer in self.writers:  # Blocks only when a writer's queue is full.
+                writer.put(df)
+        else:
+            for _, write in self.sinks:
+                write(df)
         df = None
 
-    def _df_size_check(self, df: DataFrame) -> bool:
-        _, n_col = df.shape
-        t_row = sum(len(result) for result in self.results)
-        return t_row * n_col > NUM_CELLS
+    def drain(self):
+        """Wait until every queued DataFrame has been written to all sinks."""
+        for writer in self.writers:
+            writer.drain()
+        if (drain := getattr(self.remote, 'drain', None)) is not None:
+            drain()
+
+    def _flush_rows(self, buffer: ResultBuffer) -> int:
+        """The rows of `buffer` that the policy lets accumulate before a flush, as far as it can tell up front."""
+        limits = [self.policy.max_rows]
+        if self.policy.max_cells is not None:
+            limits.append(self.policy.max_cells // max(buffer.cells, 1))
+        if self.policy.max_bytes is not None:
+            limits.append(round(self.policy.max_bytes / max(buffer.row_bytes, 1)))
+        return min((limit for limit in limits if limit is not None), default=BATCH_SIZE) + 1
+
+    def _append(self, result):
+        key = _schema_key(result)
+        if (buffer := self.buffers.get(key, None)) is None:
+            buffer = ResultBuffer(result)
+            buffer.reserve(min(self._flush_rows(buffer), BATCH_SIZE))  # Larger flushes grow the buffer.
+            self.buffers[key] = buffer
+        n_row = buffer.append(result)
+        self.n_results += 1
+        self.n_rows += n_row
+        self.n_cells += n_row * buffer.cells
+        self.n_bytes += round(n_row * buffer.row_bytes)
 
-    def push(self, result: DataFrame):
+    def _df_size_check(self) -> bool:
+        return self.policy.is_full(self.n_rows, self.n_cells, self.n_bytes)
+
+    def push(self, result):
         now = _now()
-        self.results.append(result)
-        if self._df_size_check(result) or (now - self.last_save) > timedelta(seconds=60.0):
+        self._append(result)
+        if self._df_size_check() or self.policy.is_stale(now - self.last_save):
             self._push_to_database()
             self.last_save = now
 
     def final_push(self):
-        if len(self.results) > 0:
+        if self.n_rows > 0:
             self._push_to_database()
-        self.local.dispose()
-        self.local = None
+        if len(self.writers) == 0:
+            for _, write in self.sinks:
+                if (flush := getattr(write, 'flush', None)) is not None:
+                    flush()
+        writers, self.writers = self.writers, []
+        errors = []
+        for writer in writers:  # Close every writer, even if an earlier one failed.
+            try:
+                writer.close()
+            except Exception as e:
+                errors.append(e)
+        if self.parquet is not None:
+            self.parquet.close()
+        self.parquet = None
+        self.sqlite.close()
+        self.sqlite = None
         if self.remote is not None:
-            self.remote.dispose()
+            logger.info(f'Remote: {self.remote.stats()}')
+            try:
+                self.remote.close()  # Waits for the writes still in flight.
+            except Exception as e:
+                errors.append(e)
         self.remote = None
-        self.credentials = None
-        self.project_id = None
+        self.gbq = None
+        self.buffers = {}
+        if len(errors) > 0:
+            raise errors[0]
 
-    def _first_result(self) -> DataFrame | None:
-        return self.results[0] if len(self.results) > 0 else None
+    def push_failures(self, failures: list):
+        """Record failed instances in the `<table_name>_failures` side table of the local database."""
+        df = DataFrame([{'params': json.dumps({k: _canonical_value(v) for k, v in f['params'].items()}, default=repr),
+                         'exception': f['exception'], 'traceback': f['traceback'], 'worker': f['worker'],
+                         'attempt': f.get('attempt', 1), 'time': _now().isoformat()} for f in failures])
+        self.sqlite.write(f'{self.table_name}_failures', df)
 
     def push_batch(self):
         now = _now()
-        df = self._first_result()
-        if df is not None and (self._df_size_check(df) or (now - self.last_save) > timedelta(seconds=60.0)):
+        if self.n_rows > 0 and (self._df_size_check() or self.policy.is_stale(now - self.last_save)):
             self._push_to_database()
             self.last_save = now
 
-    def batch_result(self, result: DataFrame):
-        self.results.append(result)
-        if self._df_size_check(result):  # If the batch write is already large, push it.
-            logger.warning(f'batch_result(): Early Push: Number of Columns: {result.shape[1]}; ' +
-                           f'Length of DataFrames: {sum(len(df) for df in self.results)}')
+    def batch_result(self, result):
+        self._append(result)
+        if self._df_size_check():  # If the batch write is already large, push it.
+            logger.warning(f'batch_result(): Early Push: Number of Cells: {self.n_cells}; ' +
+                           f'Length of DataFrames: {self.n_rows}')
             self.push_batch()
 
+    def _source(self):
+        """The sink that reads come from: the remote database, else BigQuery, else Parquet, else the local SQLite."""
+        for sink in (self.remote, self.gbq, self.parquet):
+            if sink is not None:
+                return sink
+        return self.sqlite
+
     def read_table(self) -> DataFrame:
-        df = None
-        if self.remote is not None:
-            pass
-        elif self.credentials is not None:
-            try:
-                df = pd.read_gbq(f'SELECT * FROM `EMS.{self.table_name}`', credentials=self.credentials)
-            except pandas_gbq.exceptions.GenericGBQException as e:
-                logger.error(f'{e}')
-                df = None
-        elif self.project_id is not None:
-            try:
-                df = pd.read_gbq(f'SELECT * FROM `EMS.{self.table_name}`', project_id=self.project_id)
-            except pandas_gbq.exceptions.GenericGBQException as e:
-                logger.error(f'{e}')
-                df = None
+        if (source := self._source()) is self.parquet:
+            df = self.parquet.read()
         else:
-            try:
-                df = pd.read_sql_table(self.table_name, self.local)
-            except ValueError:
-                df = None
+            df = source.read(self.table_name)
         return df
 
+    def read_chunks(self, chunksize: int = CHUNK_ROWS) -> Iterator[DataFrame]:
+        """Stream the results table in DataFrames of at most `chunksize` rows, so it never has to fit in memory."""
+        if (source := self._source()) is self.parquet:
+            yield from self.parquet.read_chunks(chunksize)
+        else:
+            yield from source.read_chunks(self.table_name, chunksize)
+
     def read_params(self, params: list) -> DataFrame:
         df = None
         if len(params) > 0:
-            keys = ','.join(sorted(params[0].keys()))
-            if self.remote is not None:
-                pass
-            elif self.credentials is not None:
-                try:
-                    df = pd.read_gbq(f'SELECT DISTINCT {keys} FROM `EMS.{self.table_name}`',
-                                     credentials=self.credentials)
-                except pandas_gbq.exceptions.GenericGBQException as e:
-                    logger.error(f'{e}')
-                    df = None
-            elif self.project_id is not None:
-                try:
-                    df = pd.read_gbq(f'SELECT DISTINCT {keys} FROM `EMS.{self.table_name}`', project_id=self.project_id)
-                except pandas_gbq.exceptions.GenericGBQException as e:
-                    logger.error(f'{e}')
-                    df = None
+            keys = sorted(params[0].keys())
+            if (source := self._source()) is self.parquet:  # Only the key columns are scanned.
+                df = self.parquet.read(columns=keys)
+                df = df.drop_duplicates() if df is not None else None
             else:
-                try:
-                    df = pd.read_sql_query(f'SELECT DISTINCT {keys} FROM {self.table_name}', self.local)
-                except (ValueError, OperationalError) as e:
-                    logger.error(f'{e}')
-                    df = None
+                df = source.read(self.table_name, columns=keys)
         else:
             df = self.read_table()
         return df
 
+    def _missing_parquet(self, grid: 'ParameterGrid', keys: list) -> array | None:
+        df = self.parquet.read(columns=keys)
+        if df is None:
+            return None
+        done = set(tuple(row) for row in df[keys].to_numpy())
+        df = None
+        missing = array('q')
+        for index, p in enumerate(grid):
+            values = tuple(p[k] for k in keys)
+            if values not in done:
+                done.add(values)
+                missing.append(index)
+        return missing
 
-# The Cloud SQL Python Connector can be used along with SQLAlchemy using the
-# 'creator' argument to 'create_engine'
-def create_remote_connection_engine() -> Engine:
-    def get_conn() -> Connection:
-        connector = Connector()
-        connection: Connection = connector.connect(
-            os.environ["POSTGRES_CONNECTION_NAME"],
-            "pg8000",
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASS"],
-            db=os.environ["POSTGRES_DB"],
-        )
-        return connection
-
-    engine = create_engine(
-        "postgresql+pg8000://",
-        creator=get_conn,
-        echo=False,
-        pool_pre_ping=True  # Force reestablishing the connection.
-    )
-    engine.dialect.description_encoding = None
-    return engine
-
-
-def active_remote_engine() -> (Engine, MetaData):
-    remote = create_remote_connection_engine()
-    metadata = MetaData()
-    try:
-        metadata.reflect(remote)  # Causes a DB query.
-        return remote, metadata
-    except SQLAlchemyError as e:
-        logger.error("%s", e)
-        remote.dispose()
-    return None, None
-
-
-def get_gbq_credentials(cred_name: str = 'hs-deep-lab-donoho-3d5cf4ffa2f7.json') -> service_account.Credentials:
-    path = f'~/.config/gcloud/{cred_name}'  # Pandas-GBQ-DataSource
-    expanded_path = os.path.expanduser(path)
-    credentials = service_account.Credentials.from_service_account_file(expanded_path)
-    return credentials
+    def missing_params(self, grid: 'ParameterGrid') -> array | None:
+        """
+        Return the indices of the grid points whose keys are not in the results table, one per distinct key tuple.
+        The keys are uploaded to a staging table and anti-joined on the server; only the missing indices come back.
+        Returns None when the results table cannot be read, i.e. every grid point must be computed.
+        """
+        missing = None
+        if len(grid) > 0:
+            keys = sorted(grid[0].keys())
+            if (source := self._source()) is self.parquet:
+                missing = self._missing_parquet(grid, keys)
+            else:
+                missing = source.missing(self.table_name, grid, keys, f'{self.table_name}_ems_stage')
+        return missing
 
 
 def unroll_parameters(parameters: dict) -> list:
@@ -280,6 +708,78 @@ def unroll_parameters_gpt(parameters: dict) -> list:
     return unrolled
 
 
+def _permutation(n: int, seed: int = None) -> Iterator[int]:
+    """
+    Yield a pseudo-random permutation of range(n) in O(1) memory.
+    A 4 round Feistel network permutes the smallest even-bit domain holding n. Values outside range(n) are
+    re-encrypted until they land inside it (cycle walking). The domain is less than 4n, so this terminates quickly.
+    """
+    if n <= 1:
+        yield from range(n)
+        return
+    half = ((n - 1).bit_length() + 1) // 2
+    mask = (1 << half) - 1
+    rng = random.Random(seed)
+    round_keys = [rng.getrandbits(64) for _ in range(4)]
+
+    def encrypt(x: int) -> int:
+        left, right = x >> half, x & mask
+        for k in round_keys:
+            left, right = right, left ^ (hash((right, k)) & mask)  # Integer tuple hashes are not salted.
+        return (left << half) | right
+
+    for i in range(n):
+        x = encrypt(i)
+        while x >= n:
+            x = encrypt(x)
+        yield x
+
+
+class ParameterGrid(object):
+    """
+    The union of one or more cartesian products of parameter axes. Only the axes are stored.
+    A flat index is decoded into a parameter dict with mixed-radix arithmetic. The last key varies fastest,
+    which matches the order of `unroll_parameters_gpt()`.
+    """
+
+    def __init__(self, parameters: dict | list):
+        grids = [parameters] if isinstance(parameters, dict) else parameters
+        self.keys = [list(p.keys()) for p in grids]
+        self.axes = [[list(values) for values in p.values()] for p in grids]
+        self.sizes = [prod(len(axis) for axis in axes) for axes in self.axes]
+        self.offsets = list(itertools.accumulate(self.sizes, initial=0))
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def __getitem__(self, index: int) -> dict:
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError(f'ParameterGrid index {index} out of range for length {n}')
+        g = bisect.bisect_right(self.offsets, index) - 1  # Skips over empty grids.
+        index -= self.offsets[g]
+        axes = self.axes[g]
+        values = [None] * len(axes)
+        for j in range(len(axes) - 1, -1, -1):
+            index, r = divmod(index, len(axes[j]))
+            values[j] = axes[j][r]
+        return dict(zip(self.keys[g], values))
+
+    def __iter__(self) -> Iterator[dict]:
+        for keys, axes in zip(self.keys, self.axes):
+            for combo in itertools.product(*axes):
+                yield dict(zip(keys, combo))
+
+    def shuffled(self, seed: int = None, indices: Sequence[int] = None) -> Iterator[dict]:
+        """Iterate over the grid, or the subset of it at `indices`, in a pseudo-random order."""
+        if indices is None:
+            indices = range(len(self))
+        for j in _permutation(len(indices), seed):
+            yield self[indices[j]]
+
+
 def update_index(index: int, df: DataFrame) -> DataFrame:
     as_list = df.index.tolist()
     for i in range(len(as_list)):
@@ -288,21 +788,54 @@ def update_index(index: int, df: DataFrame) -> DataFrame:
     return df
 
 
+def _canonical_value(value):
+    """Normalize a parameter value into a hashable key. Floats are compared to `STOP_LIST_DIGITS` significant digits."""
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(f'{float(value):.{STOP_LIST_DIGITS}g}')
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical_value(v) for v in value)
+    return value
+
+
+class StopList(object):
+    """
+    The stop list normalized into sets of hashable keys, one set per canonical (sorted) key ordering.
+    An entry that names fewer keys than the parameters is a wildcard over the keys it omits.
+    Membership costs one hash lookup per distinct key set, so filtering N parameters is O(N + M).
+    `dropped` counts the parameters that `filter()` has removed so far.
+    """
+
+    def __init__(self, stop: list):
+        self.dropped = 0
+        self.entries = {}
+        for s_param in stop:
+            keys = tuple(sorted(s_param.keys()))
+            self.entries.setdefault(keys, set()).add(tuple(_canonical_value(s_param[k]) for k in keys))
+
+    def __len__(self) -> int:
+        return sum(len(values) for values in self.entries.values())
+
+    def __contains__(self, param: dict) -> bool:
+        for keys, values in self.entries.items():
+            try:
+                if tuple(_canonical_value(param[k]) for k in keys) in values:
+                    return True
+            except KeyError:  # This entry names a key the parameters do not have.
+                continue
+        return False
+
+    def filter(self, parameters: Iterable[dict]) -> Iterator[dict]:
+        for param in parameters:
+            if param in self:
+                self.dropped += 1
+            else:
+                yield param
+
+
 def remove_stop_list(unrolled: list, stop: list) -> list:
-    result = []
-    sl = stop.copy()  # Copy the stop_list to allow it to shrink as items are found and removed.
-    for param in unrolled:
-        for s_param in sl:
-            if len(param) == len(s_param):  # TODO: What should we do in the case of mismatched lengths?
-                for k, v in s_param.items():
-                    if param[k] != v:
-                        break
-                else:  # no_break => all (k, v) are equal. param is IN the stop_list.
-                    sl.remove(s_param)
-                    break
-        else:  # no_break => param is NOT in the stop_list.
-            result.append(param)
-    return result
+    return list(StopList(stop).filter(unrolled))
 
 
 def timestamp() -> int:
@@ -320,22 +853,31 @@ def read_json(fn: str) -> dict:
     return d
 
 
-def record_experiment(experiment: dict):
+def record_experiment(experiment: dict) -> str:
     table_name = experiment['table_name']
     now_ts = timestamp()
-    write_json(experiment, table_name + f'-{now_ts}.json')
+    fn = table_name + f'-{now_ts}.json'
+    if shared := experiment.get('shared', None):  # The arrays themselves are not recorded, just their shapes.
+        experiment = experiment | {'shared': {name: str(v) if isinstance(v, (str, os.PathLike)) else
+                                              {'shape': list(np.shape(v)), 'dtype': str(np.asarray(v).dtype)}
+                                              for name, v in shared.items()}}
+    write_json(experiment, fn)
+    return fn
 
 
-def unroll_experiment(experiment: dict) -> list:
-    parameters = []
+def experiment_grid(experiment: dict) -> ParameterGrid:
+    grids = []
     if params := experiment.get('params', None):
-        for p in params:
-            parameters.extend(unroll_parameters_gpt(p))
+        grids = params
     elif multi_res := experiment.get('multi_res', None):
-        for p in multi_res:
-            parameters.extend(unroll_parameters_gpt(p))
+        grids = multi_res
     elif params := experiment.get('parameters', None):
-        parameters = unroll_parameters_gpt(params)
+        grids = [params]
+    return ParameterGrid(grids)
+
+
+def unroll_experiment(experiment: dict) -> list:
+    parameters = list(experiment_grid(experiment))
     if stop_list := experiment.get('stop_list', None):
         parameters = remove_stop_list(parameters, stop_list)
     return parameters
@@ -355,6 +897,19 @@ def dedup_experiment(df: DataFrame, params: list) -> list:
     return dedup
 
 
+def dedup_parameters(df: DataFrame, parameters: Iterable[dict], keys: list) -> Iterator[dict]:
+    """A streaming `dedup_experiment()`. Only the already computed keys are held in memory."""
+    df_values = set(tuple(row) for row in df[keys].to_numpy())
+
+    def dedup() -> Iterator[dict]:
+        for p in parameters:
+            values = tuple(p[k] for k in keys)
+            if values not in df_values:
+                df_values.add(values)
+                yield p
+    return dedup()
+
+
 def do_test_experiment(experiment: dict, instance: callable, client: Client,
                        remote: Engine = None,
                        credentials: service_account.credentials = None, project_id: str = None):
@@ -376,61 +931,885 @@ def do_test_experiment(experiment: dict, instance: callable, client: Client,
     logger.info(f'Number of Instances to calculate: {instance_count}')
 
 
-def do_experiment(instance: callable, parameters: list, db: Databases, client: Client):
-    instance_count = len(parameters)
+def code_fingerprint(instance: callable, version: str = None) -> str:
+    """
+    Identify the code that computes the results. An explicit `version` wins. Otherwise, hash the source file
+    that defines `instance`, so that an edit to any helper in that file also changes the fingerprint.
+    """
+    if version is not None:
+        return str(version)
+    try:
+        source = Path(pyinspect.getsourcefile(instance)).read_bytes()
+    except (TypeError, OSError):
+        code = getattr(instance, '__code__', None)
+        source = code.co_code if code is not None else getattr(instance, '__qualname__', repr(instance)).encode()
+    return hashlib.sha256(source).hexdigest()
+
+
+class ResultCache(object):
+    """
+    An on-disk, size-bounded LRU cache of result rows. The key is a hash of the code fingerprint and the
+    canonical parameter values, so the results are reused across table names and after a crash.
+    """
+
+    def __init__(self, fingerprint: str, path: str = CACHE_PATH, max_bytes: int = CACHE_BYTES):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, isolation_level=None)  # Autocommit.
+        for pragma in SQLITE_PRAGMAS:
+            self.db.execute(f'PRAGMA {pragma}')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_results_used ON results (used)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, params: dict) -> str:
+        values = json.dumps({k: _canonical_value(v) for k, v in params.items()}, sort_keys=True, default=repr)
+        return hashlib.sha256(f'{self.fingerprint}|{values}'.encode()).hexdigest()
+
+    def get(self, params: dict) -> DataFrame | None:
+        key = self.key(params)
+        row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+
+    def put(self, params: dict, result: DataFrame):
+        value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        key = self.key(params)
+        old = self.db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, value, len(value), time.time()))
+        self.size += len(value) - (old[0] if old is not None else 0)
+        if self.size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        target = self.max_bytes * 0.9  # Leave some room so eviction does not run on every put.
+        while self.size > target:
+            rows = self.db.execute('SELECT key, size FROM results ORDER BY used LIMIT 1000').fetchall()
+            if len(rows) == 0:
+                break
+            evicted = []
+            for key, size in rows:  # The least recently used, only as many as needed.
+                evicted.append((key,))
+                self.size -= size
+                if self.size <= target:
+                    break
+            self.db.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+    def filter(self, parameters: Iterable[dict], db: 'Databases') -> Iterator[dict]:
+        """Send the cached results straight to `db` and yield only the parameters that must be computed."""
+        for p in parameters:
+            if (result := self.get(p)) is not None:
+                db.batch_result(result)
+            else:
+                yield p
+
+    def close(self):
+        logger.info(f'ResultCache: Hits: {self.hits}; Misses: {self.misses}; Size: {self.size} bytes')
+        self.db.close()
+
+
+_process_setup_cache = None  # Used when not running on a worker with a registered SetupCache.
+
+
+def _setup_cache() -> SetupCache:
+    global _process_setup_cache
+    from dask.distributed import get_worker  # Already imported on a worker.
+    from EMS.plugins import SetupCache
+    try:
+        if (cache := get_worker().plugins.get(SetupCache.name, None)) is not None:
+            return cache
+    except ValueError:  # Not on a worker.
+        pass
+    if _process_setup_cache is None:
+        _process_setup_cache = SetupCache()
+        _process_setup_cache.setup()
+    return _process_setup_cache
+
+
+def worker_memoize(setup: callable) -> callable:
+    """
+    Memoize a setup function in the worker's `SetupCache`. Call it with the subset of the parameters that
+    determines the setup, e.g. `generate_design(nrow=nrow, ncol=ncol)`. The arguments must be hashable.
+    """
+    @functools.wraps(setup)
+    def memoized(*args, **kwargs):
+        key = (setup.__module__, setup.__qualname__, args, tuple(sorted(kwargs.items())))
+        return _setup_cache().get(key, lambda: setup(*args, **kwargs))
+    return memoized
+
+
+def register_setup_cache(client: Client, maxsize: int = SETUP_CACHE_SIZE):
+    from EMS.plugins import SetupCache
+    register = getattr(client, 'register_plugin', None) or client.register_worker_plugin
+    register(SetupCache(maxsize), name=SetupCache.name)
+
+
+def setup_cache_stats(client: Client) -> dict:
+    """The hits, misses and hit rate of the workers' setup caches, per worker and in total."""
+    from EMS.plugins import SetupCache
+
+    def stats(dask_worker) -> dict | None:
+        cache = dask_worker.plugins.get(SetupCache.name, None)
+        return cache.stats() if cache is not None else None
+
+    workers = {w: st for w, st in client.run(stats).items() if st is not None}
+    hits = sum(st['hits'] for st in workers.values())
+    misses = sum(st['misses'] for st in workers.values())
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(hits + misses, 1), 'workers': workers}
+
+
+_workers_seen = weakref.WeakKeyDictionary()  # Client -> (monotonic time, the scheduler's workers)
+
+
+def _workers(client: Client) -> dict:
+    """
+    The scheduler's workers, as of at most `WORKERS_INTERVAL` seconds ago. `client.scheduler_info()` is a round trip
+    to the scheduler; the submission loop asks after every batch of results.
+    """
+    now = time.monotonic()
+    seen = _workers_seen.get(client, None)
+    if seen is None or now - seen[0] > WORKERS_INTERVAL:
+        seen = (now, client.scheduler_info().get('workers', {}))
+        _workers_seen[client] = seen
+    return seen[1]
+
+
+def _affinity(client: Client, chunks: list, locality: list) -> dict:
+    """Assign each chunk to a worker by its `locality` key, so the points that share a setup share a worker."""
+    workers = sorted(_workers(client))
+    assigned = defaultdict(list)
+    for chunk in chunks:
+        key = tuple(_canonical_value(chunk[0][k]) for k in locality)
+        assigned[workers[hash(key) % len(workers)] if len(workers) > 0 else None].append(chunk)
+    return assigned
+
+
+BLAS_ENV = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+
+def set_blas_threads(n: int):
+    """Limit the BLAS/OpenMP thread pools of this process to `n` threads."""
+    for var in BLAS_ENV:  # For pools, and child processes, created from now on.
+        os.environ[var] = str(n)
+    try:
+        from threadpoolctl import threadpool_limits  # Optional; resizes the pools numpy has already loaded.
+    except ImportError:
+        logger.warning('set_blas_threads(): threadpoolctl is not installed; only the environment was set.')
+        return
+    threadpool_limits(limits=n)
+
+
+def register_blas_threads(client: Client, n: int):
+    from EMS.plugins import BlasThreads
+    register = getattr(client, 'register_plugin', None) or client.register_worker_plugin
+    register(BlasThreads(n), name=BlasThreads.name)
+
+
+SHARE_MODES = ('mmap', 'scatter')
+
+
+class SharedArray(object):
+    """A handle to a `SharedInput`, which a task ships instead of the array. `open()` maps it on the worker."""
+
+    def __init__(self, digest: str, plugin: str):
+        self.key = digest
+        self.plugin = plugin
+
+    def open(self) -> np.ndarray:
+        from dask.distributed import get_worker
+        return get_worker().plugins[self.plugin].open()
+
+    def __dask_tokenize__(self):
+        return self.key
+
+
+def _shared_array(value) -> np.ndarray:
+    if isinstance(value, (str, os.PathLike)):  # An .npy file on the driver. It is read, not loaded into memory.
+        value = np.load(value, mmap_mode='r')
+    value = np.asarray(value)
+    if value.dtype.hasobject:
+        raise ValueError(f'A shared input must be a numeric or string array, not {value.dtype}')
+    return value
+
+
+def _shared_digest(value: np.ndarray) -> str:
+    h = hashlib.sha256(f'{value.dtype.str}{value.shape}'.encode())
+    flat = np.ascontiguousarray(value).reshape(-1)
+    step = max(1, 2**26 // max(value.itemsize, 1))  # 64 MiB at a time.
+    for i in range(0, flat.size, step):
+        h.update(flat[i:i + step].tobytes())
+    return h.hexdigest()
+
+
+def share_inputs(client: Client, experiment: dict, mode: str = 'mmap') -> dict | None:
+    """
+    Send the experiment's shared inputs to the workers once, rather than with every task.
+    `experiment['shared']` maps names to arrays, e.g. a design matrix, or to the paths of `.npy` files.
+    The instance gets each as a keyword argument, a read-only view of the worker's copy.
+    With `mode='mmap'`, each node keeps one copy in a `.npy` file on its local storage, memory mapped by its workers;
+    see `SharedInput`. The input also stays in the scheduler's memory while the plugin is registered.
+    With `mode='scatter'`, every worker holds the array in its memory, from `client.scatter(broadcast=True)`.
+    Returns the `shared` argument of `do_experiment()`, or None if there are no shared inputs.
+    """
+    if not (inputs := experiment.get('shared', None)):
+        return None
+    if mode not in SHARE_MODES:
+        raise ValueError(f'Unknown share mode: {mode}. Use one of {", ".join(SHARE_MODES)}')
+    shared = {}
+    for name, value in inputs.items():
+        value = _shared_array(value)
+        if mode == 'scatter':  # The key is a hash of the content.
+            shared[name] = client.scatter(value, broadcast=True, hash=True)
+        else:
+            from EMS.plugins import SharedInput
+            plugin = SharedInput(_shared_digest(value), value)
+            register = getattr(client, 'register_plugin', None) or client.register_worker_plugin
+            register(plugin, name=plugin.name)
+            shared[name] = SharedArray(plugin.digest, plugin.name)
+        logger.info(f'Shared input {name}: {value.shape} {value.dtype}, {value.nbytes / 2**20:.1f} MiB; {mode}')
+    return shared
+
+
+def _shared_views(shared: dict | None) -> dict:
+    """The instance's keyword arguments for the shared inputs: read-only views, without copying."""
+    views = {}
+    for name, value in (shared or {}).items():
+        if isinstance(value, SharedArray):
+            value = value.open()
+        view = value.view()
+        view.flags.writeable = False
+        views[name] = view
+    return views
+
+
+def _shared_fingerprint(fingerprint: str, shared: dict | None) -> str:
+    """A cached result also depends on the content of the shared inputs."""
+    if not shared:
+        return fingerprint
+    keys = ''.join(f'{name}={value.key};' for name, value in sorted(shared.items()))
+    return hashlib.sha256((fingerprint + keys).encode()).hexdigest()
+
+
+def _layouts(cores: int) -> list:
+    """Every (processes, threads per process, BLAS threads) that uses exactly `cores` cores."""
+    return [(p, t, cores // (p * t)) for p in range(1, cores + 1) if cores % p == 0
+            for t in range(1, cores // p + 1) if (cores // p) % t == 0]
+
+
+def autotune(experiment: dict, instance: callable, cores: int = None, layouts: list = None,
+             sample: int = AUTOTUNE_SAMPLE, share: str = 'mmap') -> dict:
+    """
+    Time a sample of the experiment's own instances on a `LocalCluster` under each candidate layout of worker
+    processes, threads per process and BLAS threads, and record the fastest as `experiment['layout']`.
+    Run it on the kind of node that will do the work. `do_on_cluster()` applies the layout's BLAS threads;
+    the processes and threads configure the cluster, e.g. `SLURMCluster(cores=..., processes=...)`.
+    """
+    from dask.distributed import Client, LocalCluster
+
+    cores = cores or os.cpu_count()
+    grid = experiment_grid(experiment)
+    points = list(itertools.islice(grid.shuffled(seed=0), sample))
+    candidates = []
+    for processes, threads, blas_threads in layouts or _layouts(cores):
+        with LocalCluster(n_workers=processes, threads_per_worker=threads, processes=True) as cluster:
+            with Client(cluster) as client:
+                register_blas_threads(client, blas_threads)
+                shared = share_inputs(client, experiment, share)
+
+                def run(p: dict, shared: dict = None):
+                    return instance(**p, **_shared_views(shared))
+                warm = points[:processes * threads]  # Imports, caches and BLAS pools are warmed up untimed.
+                client.gather(client.map(run, warm, shared=shared, pure=False))
+                tick = time.perf_counter()
+                client.gather(client.map(run, points, shared=shared, pure=False))
+                seconds = time.perf_counter() - tick
+        candidates.append({'processes': processes, 'threads': threads, 'blas_threads': blas_threads,
+                           'instances_per_second': len(points) / seconds})
+        logger.info(f'autotune(): {candidates[-1]}')
+    best = max(candidates, key=lambda c: c['instances_per_second'])
+    experiment['layout'] = best | {'cores': cores, 'sample': len(points), 'candidates': candidates}
+    return experiment['layout']
+
+
+def lifetime_args(walltime: str, margin: float = 120.0, stagger: float = 60.0) -> list:
+    """
+    Worker arguments that gracefully retire a job's workers `margin` seconds before its SLURM `walltime`
+    ('[[HH:]MM:]SS') expires. `stagger` spreads the retirements so that jobs roll over one at a time.
+    Pass them as `SLURMCluster(worker_extra_args=...)`; a `ThroughputScaler` then starts the replacement jobs.
+    """
+    seconds = 0
+    for part in walltime.split(':'):
+        seconds = seconds * 60 + int(part)
+    lifetime = max(seconds - margin - stagger, 60.0)
+    return ['--lifetime', f'{lifetime:.0f}s', '--lifetime-stagger', f'{stagger:.0f}s']
+
+
+class ThroughputScaler(object):
+    """
+    Sizes a cluster so that the remaining instances finish within `target` seconds of its creation.
+    The size comes from the remaining instance count and the measured seconds per instance per thread. When the
+    ETA misses the target, it scales up; as the queue drains, it scales down. Every decision calls `cluster.scale()`,
+    which also restarts the jobs whose workers have retired (see `lifetime_args()`).
+    Works with any `SpecCluster`, e.g. a `SLURMCluster` or, to stand in for one, a `LocalCluster`.
+    """
+
+    def __init__(self, cluster, target: float, minimum: int = 1, maximum: int = 64, interval: float = SCALE_INTERVAL):
+        self.cluster = cluster
+        self.deadline = time.monotonic() + target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.last_update = None
+        self.workers = None
+
+    def update(self, client: Client, remaining: int, s_instance: float | None):
+        now = time.monotonic()
+        if s_instance is None or (self.last_update is not None and now - self.last_update < self.interval):
+            return
+        self.last_update = now
+        workers = client.scheduler_info().get('workers', {}).values()
+        threads = max(round(sum(w.get('nthreads', 1) for w in workers) / max(len(workers), 1)), 1)
+        time_left = max(self.deadline - now, self.interval)  # Once late, aim to finish within an interval.
+        n = math.ceil(remaining * s_instance / time_left / threads)
+        n = min(n, math.ceil(remaining / threads))  # Never more threads than instances.
+        n = max(self.minimum, min(self.maximum, n))
+        if n != self.workers:
+            eta = remaining * s_instance / max(len(workers) * threads, 1)
+            logger.info(f'ThroughputScaler: Workers: {len(workers)} -> {n}; Remaining Count: {remaining}; ' +
+                        f'ETA (s): {round(eta)}; Target (s): {round(self.deadline - now)}')
+        self.workers = n
+        self.cluster.scale(n)
+
+
+def _in_flight_window(client: Client) -> int:
+    workers = _workers(client)
+    threads = sum(w.get('nthreads', 1) for w in workers.values())
+    return max(threads, 1) * IN_FLIGHT_PER_THREAD
+
+
+def batch_instance(group_by: list = None) -> callable:
+    """
+    Mark an instance as vectorized. It is called once per task with a DataFrame of parameter points, one row each,
+    and returns a DataFrame of their results, ideally one row per point in the same order.
+    The points of a task agree on the `group_by` parameters, e.g. ['nrow', 'ncol'], so that their data can be stacked.
+    Use `chunk_size` to set how many points a task gets.
+    """
+    def mark(instance: callable) -> callable:
+        instance.ems_batch = True
+        instance.ems_group_by = list(group_by) if group_by else []
+        return instance
+    return mark
+
+
+def _chunks(parameters: Iterator[dict], size: callable, group_by: list = None,
+            max_pending: int = MAX_PENDING_POINTS) -> Iterator[list]:
+    """
+    Pack the parameters into chunks of `size()` points. The points of a chunk agree on the `group_by` keys.
+    With many distinct keys, at most `max_pending` points wait in partly filled chunks; beyond that, the oldest
+    chunk is sent as it is, so the stream is never read much further ahead than the submissions.
+    """
+    pending = {}  # Key -> chunk, oldest first.
+    n_pending = 0
+    for p in parameters:
+        key = tuple(_canonical_value(p[k]) for k in group_by) if group_by else ()
+        chunk = pending.setdefault(key, [])
+        chunk.append(p)
+        n_pending += 1
+        if len(chunk) >= size():
+            n_pending -= len(chunk)
+            yield pending.pop(key)
+        elif n_pending > max_pending:
+            chunk = pending.pop(next(iter(pending)))
+            n_pending -= len(chunk)
+            yield chunk
+    yield from pending.values()
+
+
+def _failure(params: dict, e: BaseException, worker: str = None) -> dict:
+    return {'params': params, 'exception': repr(e),
+            'traceback': ''.join(traceback.format_exception(type(e), e, e.__traceback__)), 'worker': worker}
+
+
+def _run_chunk(instance: callable, chunk: list, shared: dict = None) -> tuple:
+    """
+    Run several instances in one task. Returns the list of results (empty if every instance failed), the count
+    of successful instances, the seconds per instance, the worker's wall clock time when the task started,
+    the number of rows of each instance's result (None for a failure) and the failures.
+    The results are returned as the instance made them, e.g. dicts, so a task is not turned into DataFrames here.
+    The `shared` inputs are passed to every instance; see `share_inputs()`.
+    """
+    from dask.distributed import get_worker  # Already imported on a worker.
+    try:
+        worker = get_worker().address
+    except ValueError:  # Not on a worker.
+        worker = None
+    started = time.time()
+    tick = time.perf_counter()
+    failures = []
+    views = _shared_views(shared)
+    if getattr(instance, 'ems_batch', False):
+        try:
+            results = [instance(DataFrame(chunk), **views)]
+            rows = [1] * len(chunk) if _result_rows(results[0]) == len(chunk) else None  # Unknown row to point mapping.
+        except Exception as e:
+            results, rows = [], None
+            failures = [_failure(p, e, worker) for p in chunk]
+    else:
+        results = []
+        rows = []
+        for p in chunk:
+            try:
+                results.append(instance(**p, **views))
+                rows.append(_result_rows(results[-1]))
+            except Exception as e:  # Isolate the failure; the rest of the chunk still runs.
+                failures.append(_failure(p, e, worker))
+                rows.append(None)
+    s_i = (time.perf_counter() - tick) / len(chunk)
+    return results, len(chunk) - len(failures), s_i, started, rows, failures
+
+
+def _per_point(chunk: list, rows: list, results: list) -> Iterator[tuple]:
+    """Pair each successful point of a chunk with its part of the task's results."""
+    points = [p for p, n in zip(chunk, rows) if n is not None]
+    if len(results) == len(points):  # One result per instance.
+        yield from zip(points, results)
+    else:  # One result of a batch instance, one row per point.
+        yield from ((p, _take(results[0], j, 1)) for j, p in enumerate(points))
+
+
+class Progress(object):
+    """The live count and ETA of an experiment, updated by `do_experiment()` as its results return."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.total = None
+        self.done = 0
+        self.tick = time.perf_counter()
+        self.finished = False
+
+    def update(self, done: int, total: int):
+        self.done = done
+        self.total = total
+
+    def eta(self) -> float | None:
+        """Seconds until the remaining instances are done, at the throughput so far."""
+        if self.finished:
+            return 0.0
+        if self.total is None or self.done == 0:
+            return None
+        return (time.perf_counter() - self.tick) / self.done * max(self.total - self.done, 0)
+
+    def __str__(self) -> str:
+        eta = self.eta()
+        return (f'{self.name}: Count: {self.done}; Remaining Count: {max((self.total or 0) - self.done, 0)}; ' +
+                f'Remaining (s): {round(eta) if eta is not None else None}' + ('; Finished' if self.finished else ''))
+
+
+def do_experiment(instance: callable, parameters: Iterable[dict], db: Databases, client: Client,
+                  instance_count: int = None, window: int | callable = None, chunk_size: int | None = 1,
+                  cache: ResultCache = None, locality: list = None,
+                  retries: int = 0, backoff: float = 1.0, speculative: float = 0.0,
+                  scaler: ThroughputScaler = None, priority: int = 0, progress: Progress = None,
+                  shared: dict = None, skipped: callable = None):
+    """
+    Run `instance(**p)` for every `p` in `parameters`, keeping at most `window` tasks in flight.
+    The window defaults to `IN_FLIGHT_PER_THREAD` times the cluster's current thread count and is topped up
+    as results return, so the parameters may be a stream of any length. A callable window is asked at every top up.
+    An instance returns a dict of scalars and arrays, a NumPy structured array or a DataFrame; see `ResultBuffer`.
+    The lighter types are cheaper to build, ship and buffer than a one-row DataFrame.
+    Each task runs `chunk_size` instances. If `chunk_size` is None, it adapts to the measured seconds per instance
+    so that a task takes about `TASK_SECONDS`. For a `batch_instance()`, each chunk is one vectorized call.
+    Computed results are added to the `cache`, if any.
+    `locality` names the parameters that determine an instance's setup. The points of a chunk then agree on them
+    and each chunk prefers the worker assigned to its setup, which keeps that worker's `SetupCache` warm.
+    The stream order, and so the live preview, stays random.
+    A failed instance, or every instance of a task whose worker died, is recorded by `Databases.push_failures()`
+    and is retried up to `retries` times, waiting `backoff` seconds, doubling after each attempt.
+    Once the parameters are exhausted, the oldest `speculative` fraction of the tasks in flight that have run for
+    `SPECULATE_AFTER` times their expected duration are submitted again. The first copy to finish wins.
+    A `scaler` resizes the cluster from the measured throughput as the run progresses.
+    The tasks carry the dask scheduler `priority`; a higher priority runs first. `progress`, if any, is kept current.
+    `shared` is the result of `share_inputs()`. The tasks carry its small handles, or futures, not the arrays.
+    `skipped`, if given, returns the number of points of `instance_count` that the stream has dropped so far,
+    such as the hits of a `ResultCache.filter()`. They are not counted as remaining.
+    """
+    import asyncio
+    from dask.distributed import as_completed, wait
+    from dask.sizeof import sizeof
+
+    if instance_count is None:
+        instance_count = len(parameters)
     i = 0
+    log_at = 10
+    in_flight = 0
+    running = {}  # Future key -> future, in submission order.
+    submitted = {}  # Future key -> the driver's wall clock time at submission.
+    chunks = {}  # Future key -> the task's parameters.
+    twins = {}  # Future key <-> the key of its speculative copy.
+    superseded = set()  # Keys of the speculative copies, or originals, that lost the race.
+    attempts = {}  # Canonical parameters -> the number of failed attempts.
+    retry_heap = []  # (due time, sequence number, parameters)
+    sequence = itertools.count()
+    stream_done = False
+    s_instance = None  # Moving average of the seconds per instance measured on the workers.
     logger.info(f'Number of Instances to calculate: {instance_count}')
     # Start the computation.
     tick = time.perf_counter()
-    futures = client.map(lambda p: instance(**p), parameters, batch_size=BATCH_SIZE)
-    for batch in as_completed(futures, with_results=True).batches():
-        for future, result in batch:
-            i += 1
-            if not (i % 10):  # Log results every tenth output
-                tock = time.perf_counter() - tick
-                remaining_count = instance_count - i
-                s_i = tock / i
-                logger.info(f'Count: {i}; Time: {round(tock)}; Seconds/Instance: {s_i:0.4f}; ' +
-                            f'Remaining (s): {round(remaining_count * s_i)}; Remaining Count: {remaining_count}')
-                logger.info(result)
-            db.batch_result(result)
-            future.release()  # As these are Embarrassingly Parallel tasks, clean up memory.
-        db.push_batch()
+    futures = as_completed(with_results=True, raise_errors=False)
+
+    def remaining() -> int:
+        return max(instance_count - i - (skipped() if skipped is not None else 0), 0)
+
+    def current_chunk_size() -> int:
+        if chunk_size:
+            return chunk_size
+        if s_instance is None:
+            return 1  # Measure before packing.
+        return max(1, min(MAX_CHUNK_SIZE, round(TASK_SECONDS / s_instance))) if s_instance > 0 else MAX_CHUNK_SIZE
+
+    group_by = getattr(instance, 'ems_group_by', None) or []
+    group_by = group_by + [k for k in locality or [] if k not in group_by]
+    parameter_chunks = _chunks(iter(parameters), current_chunk_size, group_by)
+
+    def submit(new_chunks: list, pure: bool = True, place: bool = True) -> list:
+        nonlocal in_flight
+        if locality and place:  # A loose restriction: the scheduler may still move the task to balance load.
+            assigned = _affinity(client, new_chunks, locality)
+            new_chunks, new_futures = [], []
+            for worker, cs in assigned.items():
+                new_chunks.extend(cs)
+                new_futures.extend(client.map(lambda c, shared: _run_chunk(instance, c, shared), cs, shared=shared,
+                                              pure=pure, workers=[worker] if worker is not None else None,
+                                              allow_other_workers=True, priority=priority))
+        else:
+            new_futures = client.map(lambda c, shared: _run_chunk(instance, c, shared), new_chunks, shared=shared,
+                                     pure=pure, priority=priority)
+        now = time.time()
+        for f, c in zip(new_futures, new_chunks):
+            running[f.key] = f
+            submitted[f.key] = now
+            chunks[f.key] = c
+        futures.update(new_futures)
+        in_flight += len(new_chunks)
+        return new_futures
+
+    def top_up():
+        nonlocal stream_done
+        limit = window() if callable(window) else window if window else _in_flight_window(client)
+        now = time.monotonic()
+        while in_flight < limit:
+            due = []
+            while len(retry_heap) > 0 and retry_heap[0][0] <= now and len(due) < limit - in_flight:
+                due.append([heapq.heappop(retry_heap)[2]])
+            if len(due) > 0:
+                submit(due, pure=False)  # A retry must not reuse the key of the failed task.
+                continue
+            new_chunks = list(itertools.islice(parameter_chunks, min(limit - in_flight, BATCH_SIZE)))
+            if len(new_chunks) == 0:
+                stream_done = True
+                break
+            submit(new_chunks)
+
+    def stragglers() -> list:
+        """The oldest tasks that may get a speculative copy, with the seconds until they are due one."""
+        if not speculative or not stream_done or len(retry_heap) > 0 or s_instance is None:
+            return []
+        now = time.time()
+        oldest = list(itertools.islice(running.items(), math.ceil(speculative * len(running))))
+        return [(key, submitted[key] + SPECULATE_AFTER * s_instance * len(chunks[key]) - now) for key, _ in oldest
+                if key not in twins and key not in superseded]
+
+    def speculate():
+        for key, due in stragglers():
+            if due > 0:
+                continue
+            twin = submit([chunks[key]], pure=False, place=False)[0]  # Let the scheduler pick another worker.
+            twins[key] = twin.key
+            twins[twin.key] = key
+
+    def next_batch() -> list:
+        """
+        The next results. While a straggler may become due, wait only until then and speculate, so that the slow tail
+        is re-run even though no other result returns.
+        """
+        while not futures.has_ready() and len(due := [d for _, d in stragglers()]) > 0:
+            pending = [f for f in running.values() if not f.done()]
+            if len(pending) == 0:
+                break
+            try:
+                wait(pending, timeout=max(min(due), 0.01), return_when='FIRST_COMPLETED')
+            except (TimeoutError, asyncio.TimeoutError):
+                speculate()
+            else:
+                break
+        return futures.next_batch(block=True)
+
+    def fail(failures: list):
+        now = time.monotonic()
+        for f in failures:
+            key = tuple(sorted((k, _canonical_value(v)) for k, v in f['params'].items()))
+            f['attempt'] = attempts.get(key, 0) + 1
+            if f['attempt'] <= retries:
+                attempts[key] = f['attempt']
+                heapq.heappush(retry_heap, (now + backoff * 2 ** (f['attempt'] - 1), next(sequence), f['params']))
+            else:
+                attempts.pop(key, None)
+            logger.error(f"Instance failed (attempt {f['attempt']}): {f['params']}; {f['exception']}")
+        db.push_failures(failures)
+
+    top_up()
+    while True:
+        while not futures.is_empty():
+            batch = next_batch()
+            for future, outcome in batch:
+                key = future.key
+                in_flight -= 1
+                running.pop(key, None)
+                chunk = chunks.pop(key, None) or []  # Empty for a second future of the same pure key.
+                started_at = submitted.pop(key, None)
+                if key in superseded:  # Its twin already finished.
+                    superseded.discard(key)
+                    future.release()
+                    continue
+                if (twin := twins.pop(key, None)) is not None:
+                    twins.pop(twin, None)
+                if future.status != 'finished':  # The task itself failed, e.g. its worker died.
+                    if twin is None or twin not in running:  # Unless the other copy may still succeed.
+                        e = outcome[1] if isinstance(outcome, tuple) else outcome  # (type, exception, traceback)
+                        fail([_failure(p, e) for p in chunk])
+                    future.release()
+                    continue
+                if twin is not None and (twin_future := running.get(twin, None)) is not None:
+                    superseded.add(twin)  # First result wins; cancel the other copy.
+                    twin_future.cancel()
+                results, count, s_i, started, rows, failures = outcome
+                if len(failures) > 0:
+                    fail(failures)
+                if len(results) == 0:
+                    future.release()
+                    continue
+                i += count
+                s_instance = s_i if s_instance is None else 0.8 * s_instance + 0.2 * s_i
+                if db.metrics is not None:
+                    db.metrics.instances(count, s_i, max(started - (started_at or started), 0.0), sizeof(results))
+                if i >= log_at:  # Log results about every tenth output
+                    log_at = i + 10
+                    tock = time.perf_counter() - tick
+                    remaining_count = remaining()
+                    s_i = tock / i
+                    logger.info(f'Count: {i}; Time: {round(tock)}; Seconds/Instance: {s_i:0.4f}; ' +
+                                f'Remaining (s): {round(remaining_count * s_i)}; Remaining Count: {remaining_count}')
+                    logger.info(results[-1])
+                if cache is not None and rows is not None:
+                    for p, result in _per_point(chunk, rows, results):
+                        cache.put(p, result)
+                for result in results:
+                    db.batch_result(result)
+                future.release()  # As these are Embarrassingly Parallel tasks, clean up memory.
+            db.push_batch()
+            if progress is not None:
+                progress.update(i, i + remaining())
+            if db.metrics is not None:
+                db.metrics.sample(i, remaining(), db.n_bytes)
+            if scaler is not None:
+                scaler.update(client, remaining(), s_instance)
+            top_up()
+            speculate()
+        if len(retry_heap) == 0:
+            break
+        time.sleep(max(retry_heap[0][0] - time.monotonic(), 0.0))  # Nothing in flight; wait for the next retry.
+        top_up()
+    metrics = db.metrics
     db.final_push()
+    if metrics is not None:
+        metrics.sample(i, remaining(), 0, force=True)
+        metrics.close()
     total_time = time.perf_counter() - tick
+    if locality:
+        stats = setup_cache_stats(client)
+        logger.info(f"Setup cache: Hits: {stats['hits']}; Misses: {stats['misses']}; Hit Rate: {stats['hit_rate']:0.3f}")
     logger.info(f"Performed experiment in {total_time:0.4f} seconds")
-    if instance_count > 0:
-        logger.info(f"Count: {instance_count}, Seconds/Instance: {(total_time / instance_count):0.4f}")
+    if i > 0:
+        logger.info(f"Count: {i}, Seconds/Instance: {(total_time / i):0.4f}")
 
 
-def do_on_cluster(experiment: dict, instance: callable, client: Client,
-                  remote: Engine = None,
-                  credentials: service_account.credentials = None, project_id: str = None):
-    logger.info(f'{client}')
+def run_experiment(experiment: dict, instance: callable, client: Client,
+                   remote: Engine = None,
+                   credentials: service_account.credentials = None, project_id: str = None,
+                   asynchronous: bool = False, window: int | callable = None, chunk_size: int | None = 1,
+                   db_url: str = LOCAL_DB_URL, parquet: bool = False, partition_by: list = None,
+                   remote_copy: bool = False, remote_writers: int = 0, policy: FlushPolicy = None,
+                   metrics: bool = False, cache: bool = False, locality: list = None,
+                   retries: int = 0, backoff: float = 1.0, speculative: float = 0.0,
+                   scaler: ThroughputScaler = None, priority: int = 0, progress: Progress = None,
+                   share: str = 'mmap', plugins: bool = True):
+    """
+    Run one experiment on `client`, which stays up afterwards. See `do_on_cluster()`.
+    Unless `plugins` is False, the setup cache of `locality` and the BLAS threads of the experiment's `layout`
+    are registered on the workers; `ExperimentScheduler` registers them once, for all of its experiments.
+    """
+    if plugins and locality:
+        register_setup_cache(client)
+    if plugins and (layout := experiment.get('layout', None)):  # From autotune().
+        register_blas_threads(client, layout['blas_threads'])
+    shared = share_inputs(client, experiment, share)
+    # Save the experiment domain. The metrics time series, if any, is written next to it.
+    fn = record_experiment(experiment)
+    metrics = Metrics(fn.removesuffix('.json') + '-metrics.jsonl') if metrics else None
+
     # Read the DB level parameters.
     table_name = experiment['table_name']
-    db = Databases(table_name, remote, credentials, project_id)
+    db = Databases(table_name, remote, credentials, project_id, asynchronous=asynchronous, db_url=db_url,
+                   parquet=parquet, partition_by=partition_by, remote_copy=remote_copy,
+                   remote_writers=remote_writers, policy=policy,
+                   metrics=metrics)
 
-    # Save the experiment domain.
-    record_experiment(experiment)
-
-    # Prepare parameters.
-    parameters = unroll_experiment(experiment)
-    df = db.read_params(parameters)
-    if df is not None and len(df.index) > 0:
-        parameters = dedup_experiment(df, parameters)
-    df = None  # Free up the DataFrame.
-    if len(parameters) > 0:
-        random.shuffle(parameters)
-        do_experiment(instance, parameters, db, client)
+    # Prepare parameters. The grid is streamed in a random order; it is never materialized.
+    # The points that the stop list and the cache drop are only known as they stream by. They are left out of
+    # the remaining count then, so it is an overestimate until the stream is exhausted.
+    grid = experiment_grid(experiment)
+    missing = db.missing_params(grid)  # Dedup happens on the database server.
+    instance_count = len(grid) if missing is None else len(missing)
+    parameters = grid.shuffled(indices=missing)
+    if stop_list := experiment.get('stop_list', None):
+        stop_list = StopList(stop_list)
+        parameters = stop_list.filter(parameters)
+    if cache:  # Cached results go straight to the sinks; only the misses reach the cluster.
+        cache = ResultCache(_shared_fingerprint(code_fingerprint(instance, experiment.get('version', None)), shared))
+        parameters = cache.filter(parameters, db)
+    else:
+        cache = None
+    if (first := next(parameters, None)) is not None:
+        parameters = itertools.chain([first], parameters)
+        do_experiment(instance, parameters, db, client, max(instance_count, 1), window, chunk_size, cache,
+                      locality, retries, backoff, speculative, scaler, priority, progress, shared,
+                      skipped=lambda: (stop_list.dropped if stop_list else 0) + (cache.hits if cache else 0))
     else:
-        logger.warning('Database is complete.')
+        logger.warning(f'Database is complete: {table_name}')
+        db.final_push()  # Writes any cached results.
+        if metrics is not None:
+            metrics.close()
+    if cache is not None:
+        cache.close()
+
+
+def do_on_cluster(experiment: dict, instance: callable, client: Client,
+                  remote: Engine = None,
+                  credentials: service_account.credentials = None, project_id: str = None,
+                  asynchronous: bool = False, window: int = None, chunk_size: int | None = 1,
+                  db_url: str = LOCAL_DB_URL, parquet: bool = False, partition_by: list = None,
+                  remote_copy: bool = False, remote_writers: int = 0, policy: FlushPolicy = None,
+                  metrics: bool = False, cache: bool = False, locality: list = None,
+                  retries: int = 0, backoff: float = 1.0, speculative: float = 0.0,
+                  scaler: ThroughputScaler = None, share: str = 'mmap'):
+    logger.info(f'{client}')
+    run_experiment(experiment, instance, client, remote, credentials, project_id, asynchronous, window, chunk_size,
+                   db_url, parquet, partition_by, remote_copy, remote_writers, policy, metrics, cache, locality,
+                   retries, backoff, speculative, scaler, share=share)
     client.shutdown()
 
 
+class _Job(object):
+
+    def __init__(self, experiment: dict, instance: callable, weight: float, priority: int, options: dict):
+        self.experiment = experiment
+        self.instance = instance
+        self.weight = weight
+        self.priority = priority
+        self.options = options
+        self.progress = Progress(experiment['table_name'])
+        self.error = None
+
+
+class ExperimentScheduler(object):
+    """
+    Runs several experiments at once on one client, interleaving their instances, and shuts the client down
+    when all of them are done. Each experiment has its own table, sinks, `Databases` buffer and `Progress`.
+    The client's in-flight window is shared by weighted fair share: an experiment of `weight` 2 keeps twice the tasks
+    in flight of one of weight 1. As experiments finish, their share goes to the rest. `priority` is passed to the
+    dask scheduler, which runs the queued tasks of a higher priority first.
+    Each experiment runs `run_experiment()` on its own driver thread; `add()` takes its keyword arguments.
+    Experiments that run concurrently should not share a SQLite file: give each its own `db_url`.
+    The worker plugins are registered once, before the experiments start: re-registering one replaces it, which
+    would empty the setup cache of a running experiment. The BLAS threads, a per process setting, are the fewest
+    of any experiment's `layout`.
+    """
+
+    def __init__(self, client: Client, window: int = None, interval: float = STATUS_INTERVAL):
+        self.client = client
+        self.window = window
+        self.interval = interval
+        self.jobs = []
+
+    def add(self, experiment: dict, instance: callable, weight: float = 1.0, priority: int = 0,
+            **options) -> Progress:
+        job = _Job(experiment, instance, weight, priority, options)
+        self.jobs.append(job)
+        return job.progress
+
+    def _share(self, job: _Job) -> callable:
+        def window() -> int:
+            total = self.window or _in_flight_window(self.client)
+            weights = sum(j.weight for j in self.jobs if not j.progress.finished)
+            return max(1, round(total * job.weight / max(weights, 1e-9)))
+        return window
+
+    def _register_plugins(self):
+        if any(job.options.get('locality', None) for job in self.jobs):
+            register_setup_cache(self.client)
+        layouts = [job.experiment['layout'] for job in self.jobs if job.experiment.get('layout', None)]
+        if len(layouts) > 0:
+            register_blas_threads(self.client, min(layout['blas_threads'] for layout in layouts))
+
+    def _run(self, job: _Job):
+        try:
+            run_experiment(job.experiment, job.instance, self.client, window=self._share(job),
+                           priority=job.priority, progress=job.progress, plugins=False, **job.options)
+        except Exception as e:  # Every other experiment keeps running.
+            logger.error(f'{job.progress.name}: {e}')
+            job.error = e
+        finally:
+            job.progress.finished = True
+
+    def status(self) -> list:
+        return [job.progress for job in self.jobs]
+
+    def run(self):
+        logger.info(f'{self.client}')
+        threads = [threading.Thread(target=self._run, args=(job,), name=f'EMS-{job.progress.name}')
+                   for job in self.jobs]
+        try:
+            self._register_plugins()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(self.interval)
+                    if thread.is_alive():
+                        for progress in self.status():
+                            logger.info(f'{progress}')
+        finally:
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            self.client.shutdown()
+        for progress in self.status():
+            logger.info(f'{progress}')
+        errors = [job.error for job in self.jobs if job.error is not None]
+        if len(errors) > 0:
+            raise errors[0]
+
+
 if __name__ == '__main__':
-    db_url = 'sqlite:///data/EMS.db3'
-    _touch_db_url(db_url)
+    from EMS.sinks.sqlite import _touch_db_url
+    _touch_db_url(LOCAL_DB_URL)
     # d = {
     #     'm': [50],
     #     'n': [1275, 2550, 3825],
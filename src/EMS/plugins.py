@@ -0,0 +1,91 @@
+"""
+    The dask worker plugins of EMS. Workers import this module when a plugin is registered.
+"""
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from dask.distributed import WorkerPlugin
+
+from EMS.manager import SETUP_CACHE_SIZE, set_blas_threads
+
+
+class SetupCache(WorkerPlugin):
+    """
+    A worker-scoped LRU cache of expensive setup, such as a generated design, shared by the instances that a worker
+    runs. `worker_memoize()` stores its values here. Register it with `register_setup_cache()`.
+    """
+    name = 'ems-setup-cache'
+
+    def __init__(self, maxsize: int = SETUP_CACHE_SIZE):
+        self.maxsize = maxsize
+
+    def setup(self, worker=None):
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute: callable):
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+            self.misses += 1
+        value = compute()  # Outside of the lock; other worker threads keep running.
+        with self.lock:
+            self.values[key] = value
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.values)}
+
+
+class BlasThreads(WorkerPlugin):
+    """Apply `set_blas_threads()` on every worker, including the ones that join later."""
+    name = 'ems-blas-threads'
+
+    def __init__(self, n: int):
+        self.n = n
+
+    def setup(self, worker=None):
+        set_blas_threads(self.n)
+
+
+class SharedInput(WorkerPlugin):
+    """
+    A shared input of an experiment. The first worker of a node writes it to `<scratch>/ems-shared/<digest>.npy`,
+    next to the workers' local directories, and every worker of the node memory maps that file read-only, so they
+    share one copy in the page cache. Registered by `share_inputs()`, one plugin per input.
+    """
+
+    def __init__(self, digest: str, value: np.ndarray):
+        self.name = f'ems-shared-{digest[:16]}'
+        self.digest = digest
+        self.value = value
+
+    def setup(self, worker=None):
+        root = Path(worker.local_directory).parent if worker is not None else Path(tempfile.gettempdir())
+        self.path = root / 'ems-shared' / f'{self.digest}.npy'
+        if not self.path.exists():  # A file of the same digest has the same content; it is reused.
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f'{self.digest}.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, self.value)
+            os.replace(tmp, self.path)  # Atomic; the other workers of the node never see a partial file.
+        self.value = None  # The worker keeps the map, not a copy.
+        self.array = None
+        self.lock = threading.Lock()
+
+    def open(self) -> np.ndarray:
+        with self.lock:
+            if self.array is None:
+                self.array = np.load(self.path, mmap_mode='r')
+            return self.array
@@ -0,0 +1,33 @@
+"""
+    Result sinks. Each backend lives in its own module and is imported only when a `Databases` is configured
+    to use it, so workers and scripts do not pay for the database drivers they never touch.
+"""
+
+import importlib
+
+BATCH_SIZE = 4096
+LOCAL_DB_URL = 'sqlite:///data/EMS.db3'
+SQLITE_PRAGMAS = (
+    'journal_mode=WAL',  # Readers do not block the writer and a commit appends to the log instead of a rollback copy.
+    'synchronous=NORMAL',  # With WAL, fsync at checkpoints rather than at every commit.
+    'temp_store=MEMORY',
+    'cache_size=-65536',  # 64 MiB page cache.
+    'busy_timeout=60000',
+)
+
+# Sink name, as used by `FlushPolicy.min_rows`, -> the module that implements it.
+SINKS = {
+    'local': 'EMS.sinks.sqlite',
+    'parquet': 'EMS.sinks.parquet',
+    'remote': 'EMS.sinks.postgres',
+    'gbq': 'EMS.sinks.gbq',
+}
+
+
+def load_sink(name: str):
+    """Import and return the module of the sink `name`."""
+    try:
+        module = SINKS[name]
+    except KeyError:
+        raise ValueError(f'Unknown sink: {name}; expected one of {sorted(SINKS)}') from None
+    return importlib.import_module(module)
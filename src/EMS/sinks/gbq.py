@@ -0,0 +1,109 @@
+"""
+    The Google BigQuery sink. Tables live in the `EMS` dataset.
+"""
+
+import logging
+import os
+from array import array
+from typing import Iterable, Iterator
+
+import pandas as pd
+import pandas_gbq.exceptions
+from pandas import DataFrame
+from google.oauth2 import service_account
+
+from EMS.sinks.sql import _anti_join_sql, _key_chunks
+
+logger = logging.getLogger(__name__)
+
+
+def get_gbq_credentials(cred_name: str = 'hs-deep-lab-donoho-3d5cf4ffa2f7.json') -> service_account.Credentials:
+    path = f'~/.config/gcloud/{cred_name}'  # Pandas-GBQ-DataSource
+    expanded_path = os.path.expanduser(path)
+    credentials = service_account.Credentials.from_service_account_file(expanded_path)
+    return credentials
+
+
+class GBQSink(object):
+    """Authenticates with the service account `credentials` if given, otherwise as the user of `project_id`."""
+
+    def __init__(self, credentials: service_account.Credentials = None, project_id: str = None,
+                 dataset: str = 'EMS'):
+        self.auth = {'credentials': credentials} if credentials is not None else {'project_id': project_id}
+        self.dataset = dataset
+
+    def append(self, table_name: str, df: DataFrame):
+        """Append with one load job. Unlike `write()`, a failure is raised."""
+        df.to_gbq(f'{self.dataset}.{table_name}', if_exists='append', progress_bar=False, **self.auth)
+
+    def write(self, table_name: str, df: DataFrame):
+        try:
+            self.append(table_name, df)
+        except pandas_gbq.exceptions.GenericGBQException as e:
+            logger.error("%s", e)
+
+    def read(self, table_name: str, columns: list = None) -> DataFrame | None:
+        """Read the whole table or, given `columns`, their distinct values. Returns None if it cannot be read."""
+        select = f'DISTINCT {", ".join(f"`{c}`" for c in columns)}' if columns is not None else '*'
+        try:
+            return pd.read_gbq(f'SELECT {select} FROM `{self.dataset}.{table_name}`', **self.auth)
+        except pandas_gbq.exceptions.GenericGBQException as e:
+            logger.error(f'{e}')
+            return None
+
+    def _client(self):
+        from google.cloud import bigquery  # A dependency of pandas-gbq.
+        if (credentials := self.auth.get('credentials', None)) is not None:
+            return bigquery.Client(project=credentials.project_id, credentials=credentials)
+        return bigquery.Client(project=self.auth['project_id'])
+
+    def has_table(self, table_name: str) -> bool:
+        from google.api_core.exceptions import NotFound
+        client = self._client()
+        try:
+            client.get_table(f'{self.dataset}.{table_name}')
+            return True
+        except NotFound:
+            return False
+        finally:
+            client.close()
+
+    def drop(self, table_name: str):
+        """Delete the table, if it exists. Unlike `write()`, a failure is raised."""
+        client = self._client()
+        try:
+            client.delete_table(f'{self.dataset}.{table_name}', not_found_ok=True)
+        finally:
+            client.close()
+
+    def read_chunks(self, table_name: str, chunksize: int) -> Iterator[DataFrame]:
+        """Stream the table's pages with the BigQuery client's `list_rows()`, `chunksize` rows at a time."""
+        from google.api_core.exceptions import NotFound
+        client = self._client()
+        try:
+            rows = client.list_rows(f'{self.dataset}.{table_name}', page_size=chunksize)
+            yield from rows.to_dataframe_iterable()
+        except NotFound as e:
+            logger.error(f'{e}')
+        finally:
+            client.close()
+
+    def missing(self, table_name: str, grid: Iterable[dict], keys: list, stage: str) -> array | None:
+        # BigQuery has no indices. The staging table is replaced by the next run.
+        try:
+            if not self.has_table(table_name):  # A first run; there is nothing to anti-join against.
+                return None
+            for i, chunk in enumerate(_key_chunks(grid, keys)):
+                chunk.to_gbq(f'{self.dataset}.{stage}', if_exists='replace' if i == 0 else 'append',
+                             progress_bar=False, **self.auth)
+            sql = _anti_join_sql(f'`{self.dataset}.{table_name}`', f'`{self.dataset}.{stage}`', keys,
+                                 lambda k: f'`{k}`')
+            df = pd.read_gbq(sql, **self.auth)
+            missing = array('q', df.iloc[:, 0].astype('int64'))
+        except pandas_gbq.exceptions.GenericGBQException as e:
+            logger.error(f'{e}')
+            missing = None
+        return missing
+
+    def close(self):
+        pass
@@ -0,0 +1,120 @@
+"""
+    The Parquet sink.
+"""
+
+import logging
+import threading
+import uuid
+from pathlib import Path
+from typing import Iterator
+
+from pandas import DataFrame
+
+PARQUET_ROOT = 'data'
+PARQUET_COMPACT_FILES = 32  # Compact a partition once it holds this many flush files.
+SCHEMA_FILE = '_ems_schema.arrow'  # The table's schema. Dataset discovery skips names that start with '_'.
+logger = logging.getLogger(__name__)
+
+
+class ParquetSink(object):
+    """
+    A columnar copy of the results under `<root>/<table_name>/`. Each flush is appended as a new Parquet file,
+    hive partitioned by the `partition_by` parameter columns. A background thread compacts a partition's small
+    flush files once there are `compact_files` of them. Reads prune columns and can push down pyarrow filters.
+    The schema of the first flush is kept in `<root>/<table_name>/_ems_schema.arrow`. Partition columns are read
+    back with their written types, e.g. float64, not as the strings of the directory names, in any later process.
+    Requires `pyarrow` (`pip install EMS[parquet]`).
+    """
+
+    def __init__(self, table_name: str, root: str = PARQUET_ROOT, partition_by: list = None,
+                 compact_files: int = PARQUET_COMPACT_FILES):
+        import pyarrow  # Imported here so that pyarrow stays an optional dependency.
+        import pyarrow.dataset
+        import pyarrow.ipc
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.path = Path(root) / table_name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.partition_by = list(partition_by) if partition_by else []
+        self.compact_files = compact_files
+        self.schema = self._load_schema()
+        self.compactor = None
+        self.lock = threading.Lock()  # Readers never see a partition while compaction swaps its files.
+
+    def _load_schema(self):
+        if (path := self.path / SCHEMA_FILE).exists():
+            return self.pa.ipc.read_schema(self.pa.py_buffer(path.read_bytes()))
+        return None
+
+    def _save_schema(self):
+        tmp = self.path / (SCHEMA_FILE + '.tmp')
+        tmp.write_bytes(self.schema.serialize().to_pybytes())
+        tmp.replace(self.path / SCHEMA_FILE)
+
+    def _partitioning(self):
+        if not self.partition_by:
+            return None
+        if self.schema is None:  # A dataset written before the schema was kept; its partition types are inferred.
+            return 'hive'
+        return self.pa.dataset.partitioning(self.pa.schema([self.schema.field(k) for k in self.partition_by]),
+                                            flavor='hive')
+
+    def _dataset(self):
+        return self.pa.dataset.dataset(self.path, format='parquet', partitioning=self._partitioning())
+
+    def write(self, df: DataFrame):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.schema is None:
+            if any(self.path.rglob('*.parquet')):
+                # Partition columns come back from the directory names with inferred types; keep this flush's types.
+                self.schema = self.pa.schema([table.schema.field(f.name) if f.name in self.partition_by else f
+                                              for f in self._dataset().schema])
+            else:
+                self.schema = table.schema
+            self._save_schema()
+        # Keep every file's schema identical so the dataset stays readable.
+        table = table.select(self.schema.names).cast(self.schema)
+        self.pa.dataset.write_dataset(table, self.path, format='parquet',
+                                      partitioning=self.partition_by or None, partitioning_flavor='hive',
+                                      basename_template=f'flush-{uuid.uuid4().hex}-{{i}}.parquet',
+                                      existing_data_behavior='overwrite_or_ignore')
+        if self.compactor is None or not self.compactor.is_alive():
+            self.compactor = threading.Thread(target=self.compact, name='EMS-parquet-compactor', daemon=True)
+            self.compactor.start()
+
+    def compact(self):
+        """Rewrite each partition's flush files as one file. New files are renamed into place before old ones go."""
+        partitions = {f.parent for f in self.path.rglob('flush-*.parquet')}
+        for partition in partitions:
+            files = sorted(partition.glob('flush-*.parquet'))
+            if len(files) < self.compact_files:
+                continue
+            table = self.pa.parquet.read_table([str(f) for f in files], partitioning=None)
+            name = f'compact-{uuid.uuid4().hex}.parquet'
+            tmp = partition / (name + '.tmp')
+            self.pa.parquet.write_table(table, tmp)
+            with self.lock:
+                tmp.rename(partition / name)
+                for f in files:
+                    f.unlink()
+            logger.info(f'ParquetSink: Compacted {len(files)} files into {partition / name}')
+
+    def read(self, columns: list = None, filter=None) -> DataFrame | None:
+        with self.lock:
+            if not any(self.path.rglob('*.parquet')):
+                return None
+            table = self._dataset().to_table(columns=columns, filter=filter)
+        return table.to_pandas()
+
+    def read_chunks(self, chunksize: int) -> Iterator[DataFrame]:
+        """Stream the dataset in record batches of at most `chunksize` rows. Compaction waits until it is done."""
+        with self.lock:
+            if not any(self.path.rglob('*.parquet')):
+                return
+            for batch in self._dataset().to_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.join()
+        self.compactor = None
@@ -0,0 +1,89 @@
+"""
+    The reads and the server side dedup shared by the SQLAlchemy backends.
+"""
+
+import itertools
+import logging
+from array import array
+from typing import Iterable, Iterator
+
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from EMS.sinks import BATCH_SIZE
+
+DEDUP_CHUNK = 1 << 20  # Rows of candidate parameter keys uploaded per staging table write.
+logger = logging.getLogger(__name__)
+
+
+def _key_chunks(parameters: Iterable[dict], keys: list, size: int = DEDUP_CHUNK) -> Iterator[DataFrame]:
+    """Yield the parameter keys in DataFrames of `size` rows, each row tagged with its position in the stream."""
+    parameters = iter(parameters)
+    start = 0
+    while chunk := list(itertools.islice(parameters, size)):
+        df = DataFrame(chunk, columns=keys)
+        df.insert(0, 'ems_index', range(start, start + len(chunk)))
+        start += len(chunk)
+        yield df
+
+
+def _anti_join_sql(table: str, stage: str, keys: list, quote: callable) -> str:
+    """Select one staged index per distinct key tuple that is not yet in the results table."""
+    on = ' AND '.join(f't.{quote(k)} = s.{quote(k)}' for k in keys)
+    group = ', '.join(f's.{quote(k)}' for k in keys)
+    return (f'SELECT MIN(s.ems_index) FROM {stage} s ' +
+            f'WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {on}) GROUP BY {group}')
+
+
+class SQLSink(object):
+    stage_method = None  # The `to_sql()` method that uploads the grid keys for `missing()`; None inserts in batches.
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def read(self, table_name: str, columns: list = None) -> DataFrame | None:
+        """Read the whole table or, given `columns`, their distinct values. Returns None if it cannot be read."""
+        try:
+            if columns is None:
+                return pd.read_sql_table(table_name, self.engine)
+            quote = self.engine.dialect.identifier_preparer.quote
+            return pd.read_sql_query(f'SELECT DISTINCT {", ".join(quote(c) for c in columns)} ' +
+                                     f'FROM {quote(table_name)}', self.engine)
+        except (ValueError, SQLAlchemyError) as e:
+            logger.error(f'{e}')
+            return None
+
+    def read_chunks(self, table_name: str, chunksize: int) -> Iterator[DataFrame]:
+        """Stream the table with a server side cursor, `chunksize` rows at a time."""
+        if not inspect(self.engine).has_table(table_name):
+            return
+        quote = self.engine.dialect.identifier_preparer.quote
+        with self.engine.connect().execution_options(stream_results=True) as conn:
+            yield from pd.read_sql_query(text(f'SELECT * FROM {quote(table_name)}'), conn, chunksize=chunksize)
+
+    def missing(self, table_name: str, grid: Iterable[dict], keys: list, stage: str) -> array | None:
+        """The indices of the grid points whose keys are not in `table_name`. See `Databases.missing_params()`."""
+        quote = self.engine.dialect.identifier_preparer.quote
+        table = quote(table_name)
+        try:
+            if not inspect(self.engine).has_table(table_name):
+                return None
+            with self.engine.begin() as conn:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {quote("ix_" + table_name + "_params")} ' +
+                                  f'ON {table} ({", ".join(quote(k) for k in keys)})'))
+                for i, chunk in enumerate(_key_chunks(grid, keys)):
+                    chunk.to_sql(stage, conn, if_exists='replace' if i == 0 else 'append',
+                                 index=False, chunksize=BATCH_SIZE, method=self.stage_method)
+                result = conn.execute(text(_anti_join_sql(table, quote(stage), keys, quote)))
+                missing = array('q', (row[0] for row in result))
+                conn.execute(text(f'DROP TABLE {quote(stage)}'))
+        except SQLAlchemyError as e:
+            logger.error(f'{e}')
+            missing = None
+        return missing
+
+    def close(self):
+        self.engine.dispose()
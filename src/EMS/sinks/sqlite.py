@@ -0,0 +1,92 @@
+"""
+    The local SQLite sink.
+"""
+
+import logging
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import create_engine, event, inspect, text
+
+from EMS.sinks import BATCH_SIZE, LOCAL_DB_URL, SQLITE_PRAGMAS
+from EMS.sinks.sql import SQLSink
+
+logger = logging.getLogger(__name__)
+
+
+def _touch_db_url(db_url: str):
+    db_path = db_url.split('sqlite:///')
+    if db_path[0] != db_url:  # If the string was found …
+        p = Path(db_path[1])
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.touch(exist_ok=True)
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
+
+class SQLiteSink(SQLSink):
+    """
+    The local, durable copy of the results. Each flush is one prepared `executemany()` in one transaction, which
+    binds a single row's values at a time and so stays under SQLite's bound variable limit for wide results.
+    Created tables and insert statements are cached, so the schema is not reflected on every append.
+    """
+
+    def __init__(self, db_url: str = LOCAL_DB_URL):
+        _touch_db_url(db_url)
+        super().__init__(create_engine(db_url, echo=False))
+        event.listen(self.engine, 'connect', _sqlite_pragmas)
+        self.tables = set()
+        self.statements = {}
+        self.rows = 0
+        self.seconds = 0.0
+
+    def _insert_sql(self, table_name: str, columns: tuple) -> str:
+        key = (table_name, columns)
+        if (sql := self.statements.get(key, None)) is None:
+            quote = self.engine.dialect.identifier_preparer.quote
+            sql = (f'INSERT INTO {quote(table_name)} ({", ".join(quote(c) for c in columns)}) ' +
+                   f'VALUES ({", ".join("?" for _ in columns)})')
+            self.statements[key] = sql
+        return sql
+
+    def write(self, table_name: str, df: DataFrame):
+        tick = time.perf_counter()
+        with self.engine.begin() as conn:
+            create = table_name not in self.tables and not inspect(conn).has_table(table_name)
+            if create or any(dtype.kind in 'mM' for dtype in df.dtypes):
+                # pandas creates the table with column types inferred from the values of this first flush, not from
+                # the dtypes alone, so an object column of floats is REAL, not TEXT. sqlite3 cannot bind datetimes.
+                df.to_sql(table_name, conn, if_exists='append', chunksize=BATCH_SIZE)
+            else:
+                columns = (df.index.name or 'index',) + tuple(str(c) for c in df.columns)
+                rows = list(df.itertuples(index=True, name=None))  # Python scalars, which sqlite3 can bind.
+                conn.exec_driver_sql(self._insert_sql(table_name, columns), rows)
+        self.tables.add(table_name)
+        seconds = time.perf_counter() - tick
+        self.rows += len(df)
+        self.seconds += seconds
+        logger.info(f'SQLite: {len(df)} rows in {seconds:0.3f} s; {len(df) / max(seconds, 1e-9):0.0f} rows/s; ' +
+                    f'Total: {self.rows} rows; {self.rows / max(self.seconds, 1e-9):0.0f} rows/s')
+
+    def read_chunks(self, table_name: str, chunksize: int, after: int = 0) -> Iterator[DataFrame]:
+        """
+        Stream the rows whose rowid is greater than `after`, in rowid order, i.e. the order they were appended.
+        Each chunk is one indexed range query, so no cursor stays open between chunks; rows appended meanwhile are
+        read too. The DataFrames are indexed by the rowid, named `ems_rowid`.
+        """
+        if not inspect(self.engine).has_table(table_name):
+            return
+        quote = self.engine.dialect.identifier_preparer.quote
+        sql = text(f'SELECT rowid AS ems_rowid, * FROM {quote(table_name)} WHERE rowid > :after ORDER BY rowid LIMIT :n')
+        while len(df := pd.read_sql_query(sql, self.engine, params={'after': after, 'n': chunksize},
+                                          index_col='ems_rowid')) > 0:
+            after = int(df.index[-1])
+            yield df
@@ -0,0 +1,67 @@
+import threading
+from types import SimpleNamespace
+
+import pandas as pd
+
+import EMS.export
+from EMS.export import CSVTarget, GBQTarget, export_table
+from EMS.manager import Databases
+
+
+def make_table(db_url: str, rows: int):
+    db = Databases('results', db_url=db_url)
+    for a in range(rows):
+        db.push({'a': a, 'x': a * 0.5})
+    db.final_push()
+
+
+def test_csv_export_is_incremental(tmp_path):
+    db_url = f'sqlite:///{tmp_path}/ems.db3'
+    target = CSVTarget(tmp_path / 'out')
+    make_table(db_url, 30)
+    assert export_table('results', target, db_url=db_url, chunksize=7) == 30
+    make_table(db_url, 5)
+    assert export_table('results', target, db_url=db_url, chunksize=7) == 5
+    assert len(pd.read_csv(tmp_path / 'out' / 'results.csv').index) == 35
+
+
+def test_full_csv_export_replaces_the_file(tmp_path):
+    db_url = f'sqlite:///{tmp_path}/ems.db3'
+    target = CSVTarget(tmp_path / 'out')
+    make_table(db_url, 30)
+    (tmp_path / 'out').mkdir()
+    pd.DataFrame({'a': range(30)}).to_csv(tmp_path / 'out' / 'results.csv', index=False)  # No mark: an old copy.
+    export_table('results', target, db_url=db_url)
+    export_table('results', target, db_url=db_url, full=True)
+    df = pd.read_csv(tmp_path / 'out' / 'results.csv')
+    assert list(df.columns) == ['a', 'x']
+    assert sorted(df['a']) == list(range(30))
+
+
+class FakeGBQSink(object):
+    """Keeps the BigQuery tables in memory. Chunks are appended from the export's threads."""
+    tables = {}
+    lock = threading.Lock()
+
+    def __init__(self, credentials, project_id: str, dataset: str):
+        pass
+
+    def append(self, table_name: str, df: pd.DataFrame):
+        with self.lock:
+            self.tables[table_name] = pd.concat([self.tables.get(table_name, None), df])
+
+    def drop(self, table_name: str):
+        self.tables.pop(table_name, None)
+
+
+def test_full_gbq_export_replaces_the_table(tmp_path, monkeypatch):
+    monkeypatch.setattr(EMS.export, 'load_sink', lambda name: SimpleNamespace(GBQSink=FakeGBQSink))
+    monkeypatch.setattr(FakeGBQSink, 'tables', {'results': pd.DataFrame({'a': range(30)})})  # No mark: an old copy.
+    db_url = f'sqlite:///{tmp_path}/ems.db3'
+    target = GBQTarget(project_id='ems')
+    make_table(db_url, 30)
+    export_table('results', target, db_url=db_url, chunksize=7)
+    export_table('results', target, db_url=db_url, chunksize=7, full=True)
+    df = FakeGBQSink.tables['results']
+    assert list(df.columns) == ['a', 'x']
+    assert sorted(df['a']) == list(range(30))
@@ -0,0 +1,313 @@
+import glob
+import json
+import os
+import pickle
+import threading
+import time
+
+import dask
+import numpy as np
+import pandas as pd
+import pytest
+from dask.distributed import Client, LocalCluster
+
+import EMS.manager
+from EMS.manager import (IN_FLIGHT_PER_THREAD, Databases, ExperimentScheduler, FlushPolicy, Metrics, Progress,
+                         ParameterGrid, ResultBuffer, ResultCache, StopList, _chunks, _in_flight_window, _permutation,
+                         do_on_cluster, run_experiment, unroll_parameters_gpt)
+
+
+def crash(*, a: int):
+    if a == 3:
+        os._exit(1)  # Kills the worker process.
+    return {'a': a, 'x': a * 2.0}
+
+
+def straggle(*, a: int, marker: str):
+    if a == 0 and not os.path.exists(marker):
+        open(marker, 'w').close()
+        time.sleep(10.0)  # Only the first attempt is slow.
+    time.sleep(1.0)
+    return {'a': a}
+
+
+def nap(*, a: int, seconds: float, **params):
+    time.sleep(seconds)
+    return {'a': a} | params
+
+
+def row_sum(*, a: int, X: np.ndarray):
+    return {'a': a, 'x': float(X[a].sum()), 'writeable': X.flags.writeable}
+
+
+def fail_write(table_name, df):
+    raise OSError('disk full')
+
+
+@pytest.fixture
+def tmp_cwd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # do_on_cluster() records the experiment in the current directory.
+    return tmp_path
+
+
+def test_killed_worker_is_recorded_as_a_failure(tmp_cwd):
+    db_url = f'sqlite:///{tmp_cwd}/ems.db3'
+    with dask.config.set({'distributed.scheduler.allowed-failures': 0}):
+        with LocalCluster(n_workers=2, threads_per_worker=1) as cluster, Client(cluster) as client:
+            do_on_cluster({'table_name': 'crash', 'params': [{'a': list(range(6))}]}, crash, client,
+                          db_url=db_url, retries=1, backoff=0.1)
+    db = Databases('crash', db_url=db_url)
+    assert sorted(db.read_table()['a']) == [0, 1, 2, 4, 5]
+    failures = db.sqlite.read('crash_failures')
+    # Another task on the dying worker may fail with it; its retry succeeds.
+    assert sorted(failures.loc[failures['params'] == '{"a": 3}', 'attempt']) == [1, 2]
+    db.final_push()
+
+
+def test_straggler_is_speculated_once_the_stream_is_drained(tmp_cwd):
+    marker = str(tmp_cwd / 'marker')
+    db_url = f'sqlite:///{tmp_cwd}/ems.db3'
+    with LocalCluster(n_workers=2, threads_per_worker=4) as cluster, Client(cluster) as client:
+        client.wait_for_workers(2)  # All eight tasks start at once, so the other seven return well before it is due.
+        tick = time.perf_counter()
+        run_experiment({'table_name': 'straggle', 'params': [{'a': list(range(8)), 'marker': [marker]}]}, straggle,
+                       client, db_url=db_url, speculative=1.0)
+        seconds = time.perf_counter() - tick  # Not counting the shutdown, which waits for the slow first attempt.
+    assert seconds < 5.0
+    db = Databases('straggle', db_url=db_url)
+    assert sorted(db.read_table()['a']) == list(range(8))  # One result per point; the losing copies are dropped.
+    db.final_push()
+
+
+def test_failed_final_flush_does_not_hang_final_push(tmp_cwd, monkeypatch):
+    db = Databases('flush', db_url=f'sqlite:///{tmp_cwd}/ems.db3', asynchronous=True,
+                   policy=FlushPolicy(max_rows=2, min_rows={'local': 100}))
+    monkeypatch.setattr(db.sqlite, 'write', fail_write)  # The rows are held by min_rows until the final flush.
+    for a in range(5):
+        db.push({'a': a})
+    errors = []
+
+    def final_push():
+        try:
+            db.final_push()
+        except Exception as e:
+            errors.append(e)
+    closer = threading.Thread(target=final_push, daemon=True)
+    closer.start()
+    closer.join(30.0)
+    assert not closer.is_alive()
+    assert isinstance(errors[0], OSError)
+
+
+@pytest.mark.parametrize('width', [50, 500, 2000])
+def test_array_field_columns_match_the_instances_names(width):
+    result = {'seed': 0, 've': np.arange(width, dtype=float)}
+    buffer = ResultBuffer(result)
+    buffer.append(result)
+    df = buffer.to_frame()
+    assert list(df.columns) == ['seed'] + [f've{i:0>3}' for i in range(width)]  # As experiment_batch() names them.
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.calls = 0
+
+    def scheduler_info(self):
+        self.calls += 1
+        return {'workers': {'w0': {'nthreads': 2}, 'w1': {'nthreads': 2}}}
+
+
+def test_in_flight_window_reuses_the_worker_list():
+    client = FakeClient()
+    for _ in range(100):
+        assert _in_flight_window(client) == 4 * IN_FLIGHT_PER_THREAD
+    assert client.calls == 1
+
+
+def test_metrics_queue_wait_is_per_task(tmp_path):
+    metrics = Metrics(str(tmp_path / 'metrics.jsonl'))
+    metrics.instances(8, 0.1, 2.0, 800)  # A chunk of eight instances that waited 2 s.
+    metrics.instances(8, 0.1, 4.0, 800)
+    metrics.sample(16, 0, 0, force=True)
+    metrics.close()
+    row = json.loads((tmp_path / 'metrics.jsonl').read_text())
+    assert row['queue_wait_seconds'] == 3.0
+    assert row['compute_seconds'] == 0.1
+
+
+def test_chunks_bound_the_points_held_in_partial_groups():
+    read = []
+
+    def stream():
+        for i in range(10_000):
+            read.append(i)
+            yield {'g': i % 1000, 'i': i}  # A thousand groups, none of which fills a chunk of 64 soon.
+    chunks = _chunks(stream(), lambda: 64, ['g'], max_pending=100)
+    first = next(chunks)
+    assert len(read) <= 101
+    assert all(p['g'] == first[0]['g'] for p in first)
+    rest = list(chunks)
+    assert sorted(p['i'] for c in [first] + rest for p in c) == list(range(10_000))
+    assert all(len({p['g'] for p in c}) == 1 for c in rest)
+
+
+def test_result_buffer_keeps_missing_numbers_numeric():
+    buffer = ResultBuffer({'i': 0, 'x': None, 's': 'a'})
+    buffer.append({'i': 0, 'x': None, 's': 'a'})
+    buffer.append({'i': None, 'x': 0.5, 's': None})
+    buffer.append({'i': 2, 'x': 1, 's': 'c'})
+    df = buffer.to_frame()
+    assert df['i'].dtype == np.float64 and df['x'].dtype == np.float64
+    assert df['i'].isna().tolist() == [False, True, False]
+    assert df['x'].tolist()[1:] == [0.5, 1.0] and np.isnan(df['x'][0])
+    assert df['s'].isna().tolist() == [False, True, False] and df['s'][2] == 'c'
+
+
+def test_scheduler_shares_the_window_by_weight():
+    scheduler = ExperimentScheduler(None, window=12)
+    light = scheduler.add({'table_name': 'light'}, nap)
+    scheduler.add({'table_name': 'heavy'}, nap, weight=2.0)
+    windows = [scheduler._share(job) for job in scheduler.jobs]
+    assert [window() for window in windows] == [4, 8]
+    light.finished = True  # Its share goes to the rest.
+    assert windows[1]() == 12
+
+
+def test_scheduler_registers_plugins_once_and_shuts_down_last(tmp_cwd, monkeypatch):
+    registered = []
+    monkeypatch.setattr(EMS.manager, 'register_setup_cache', lambda client: registered.append('cache'))
+    monkeypatch.setattr(EMS.manager, 'register_blas_threads', lambda client, n: registered.append(n))
+    with LocalCluster(n_workers=2, threads_per_worker=2) as cluster, Client(cluster) as client:
+        finished_at_shutdown = []
+        shutdown = client.shutdown
+        monkeypatch.setattr(client, 'shutdown', lambda: (finished_at_shutdown.extend(scheduler.status()), shutdown()))
+        scheduler = ExperimentScheduler(client, window=4)
+        for name, seconds, threads in (('fast', 0.0, 2), ('slow', 0.5, 1)):
+            scheduler.add({'table_name': name, 'params': [{'a': list(range(6)), 'seconds': [seconds]}],
+                           'layout': {'blas_threads': threads}}, nap,
+                          db_url=f'sqlite:///{tmp_cwd}/{name}.db3', locality=['a'])
+        scheduler.run()
+    assert registered == ['cache', 1]  # Once for both experiments, with the fewest BLAS threads.
+    assert [progress.finished for progress in finished_at_shutdown] == [True, True]
+    for name in ('fast', 'slow'):
+        db = Databases(name, db_url=f'sqlite:///{tmp_cwd}/{name}.db3')
+        assert sorted(db.read_table()['a']) == list(range(6))
+        db.final_push()
+
+
+def test_result_cache_evicts_the_least_recently_used(tmp_path):
+    rows = [pd.DataFrame({'a': a, 'x': np.zeros(100)}) for a in range(3)]
+    size = len(pickle.dumps(rows[0], protocol=pickle.HIGHEST_PROTOCOL))
+    cache = ResultCache('f', path=str(tmp_path / 'cache.db3'), max_bytes=int(2.5 * size))
+    cache.put({'a': 0}, rows[0])
+    cache.put({'a': 1}, rows[1])
+    time.sleep(0.01)
+    assert cache.get({'a': 0}) is not None  # Now more recently used than a=1.
+    cache.put({'a': 2}, rows[2])
+    assert [cache.get({'a': a}) is not None for a in range(3)] == [True, False, True]
+    assert cache.size == 2 * size
+    cache.close()
+
+
+def test_result_cache_key_is_stable(tmp_path):
+    path = str(tmp_path / 'cache.db3')
+    cache = ResultCache('f', path=path)
+    assert cache.key({'a': 1, 'b': 0.1 + 0.2}) == cache.key({'b': np.float64(0.3), 'a': np.int64(1)})
+    assert cache.key({'a': 1}) != ResultCache('g', path=path).key({'a': 1})
+    cache.put({'a': 1, 'b': 0.3}, pd.DataFrame({'x': [1.0]}))
+    cache.close()
+    cache = ResultCache('f', path=path)  # After a restart.
+    assert cache.get({'b': 0.1 + 0.2, 'a': 1})['x'].tolist() == [1.0]
+    cache.close()
+
+
+def test_cache_hits_are_not_counted_as_remaining(tmp_cwd):
+    db_url = f'sqlite:///{tmp_cwd}/ems.db3'
+    with LocalCluster(n_workers=1, threads_per_worker=2) as cluster, Client(cluster) as client:
+        run_experiment({'table_name': 'first', 'params': [{'a': list(range(9)), 'seconds': [0.0]}]}, nap, client,
+                       db_url=db_url, cache=True)
+        progress = Progress('second')
+        run_experiment({'table_name': 'second', 'params': [{'a': list(range(10)), 'seconds': [0.0]}]}, nap, client,
+                       db_url=db_url, cache=True, metrics=True, progress=progress)
+    assert (progress.done, progress.total) == (1, 1)  # Only a=9 was computed.
+    [fn] = glob.glob(str(tmp_cwd / 'second-*-metrics.jsonl'))
+    with open(fn) as f:
+        last = [json.loads(line) for line in f][-1]
+    assert (last['done'], last['remaining']) == (1, 0)
+    db = Databases('second', db_url=db_url)
+    assert sorted(db.read_table()['a']) == list(range(10))
+    db.final_push()
+
+
+def test_stop_list_matches_floats_wildcards_and_missing_keys():
+    stop_list = StopList([{'a': 1, 'b': 0.1 + 0.2}, {'a': 3}, {'c': 1}])
+    params = [{'a': a, 'b': b} for a in (np.int64(1), 2, 3) for b in (0.3, 0.5)]
+    kept = list(stop_list.filter(params))
+    # 0.1 + 0.2 matches 0.3; {'a': 3} matches every b; {'c': 1} names a key the parameters do not have.
+    assert [(int(p['a']), p['b']) for p in kept] == [(1, 0.5), (2, 0.3), (2, 0.5)]
+    assert stop_list.dropped == 3
+
+
+def test_stop_list_wildcards_are_not_counted_as_remaining(tmp_cwd):
+    db_url = f'sqlite:///{tmp_cwd}/ems.db3'
+    progress = Progress('stop')
+    with LocalCluster(n_workers=1, threads_per_worker=2) as cluster, Client(cluster) as client:
+        run_experiment({'table_name': 'stop', 'params': [{'a': [1, 2, 3], 'b': [0.5, 1.5], 'seconds': [0.0]}],
+                        'stop_list': [{'a': 3}]}, nap, client, db_url=db_url, metrics=True, progress=progress)
+    assert (progress.done, progress.total) == (4, 4)
+    [fn] = glob.glob(str(tmp_cwd / 'stop-*-metrics.jsonl'))
+    with open(fn) as f:
+        last = [json.loads(line) for line in f][-1]
+    assert (last['done'], last['remaining']) == (4, 0)
+
+
+def test_parameter_grid_decodes_like_unroll_parameters_gpt():
+    d = {'m': [50], 'n': [1275, 2550, 3825], 'c4': np.linspace(0.25, 2.5, 4), 'q_type': [21, 22]}
+    grid = ParameterGrid(d)
+    unrolled = unroll_parameters_gpt(d)
+    assert len(grid) == len(unrolled) == 24
+    assert [grid[i] for i in range(len(grid))] == unrolled == list(grid)
+    assert grid[-1] == unrolled[-1]
+    with pytest.raises(IndexError):
+        grid[len(grid)]
+
+
+def test_parameter_grid_of_a_union_and_of_empty_grids():
+    d1, empty, d2 = {'a': [1, 2], 'b': ['x', 'y', 'z']}, {'a': [], 'b': ['x']}, {'c': [0.5, 1.5]}
+    grid = ParameterGrid([d1, empty, d2])
+    union = unroll_parameters_gpt(d1) + unroll_parameters_gpt(d2)
+    assert len(grid) == 8
+    assert [grid[i] for i in range(len(grid))] == union == list(grid)
+    for empty_grid in (ParameterGrid(empty), ParameterGrid([])):
+        assert len(empty_grid) == 0 and list(empty_grid) == [] and list(empty_grid.shuffled()) == []
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 3, 5, 17, 256, 1000, 1025])
+def test_permutation_is_a_permutation(n):
+    order = list(_permutation(n, seed=7))
+    assert sorted(order) == list(range(n))
+    assert order == list(_permutation(n, seed=7))  # The seed fixes the order.
+    if n >= 256:
+        assert order != list(range(n)) and order != list(_permutation(n, seed=8))
+
+
+def test_shuffled_subset_yields_each_point_once():
+    grid = ParameterGrid([{'a': list(range(10)), 'b': [0.5, 1.5]}, {'c': ['u', 'v', 'w']}])
+    indices = [0, 3, 7, 19, 20, 22]
+    shuffled = list(grid.shuffled(seed=1, indices=indices))
+    assert sorted(map(str, shuffled)) == sorted(str(grid[i]) for i in indices)
+    assert sorted(map(str, grid.shuffled(seed=1))) == sorted(map(str, grid))
+
+
+@pytest.mark.parametrize('share', ['mmap', 'scatter'])
+def test_shared_inputs_reach_the_instances_read_only(tmp_cwd, share):
+    db_url = f'sqlite:///{tmp_cwd}/ems.db3'
+    X = np.arange(12.0).reshape(4, 3)
+    with LocalCluster(n_workers=2, threads_per_worker=1) as cluster, Client(cluster) as client:
+        run_experiment({'table_name': 'shared', 'params': [{'a': list(range(4))}], 'shared': {'X': X}}, row_sum,
+                       client, db_url=db_url, share=share)
+    db = Databases('shared', db_url=db_url)
+    df = db.read_table().sort_values('a')
+    assert df['x'].tolist() == X.sum(axis=1).tolist()
+    assert not df['writeable'].astype(bool).any()
+    db.final_push()